@@ -1,100 +1,862 @@
 import os
+import json
 import uuid
 import calendar # <-- (V4) เพิ่ม
-from flask import Flask, request, jsonify, render_template, url_for, redirect, abort, flash
+import csv
+import hashlib
+import hmac
+import io
+import zipfile
+from xml.sax.saxutils import escape as xml_escape
+import time
+import random
+import queue
+import threading
+import asyncio
+import atexit
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from flask import Flask, Blueprint, current_app, request, jsonify, render_template, url_for, redirect, abort, flash, make_response, Response, stream_with_context, has_request_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, extract, and_ # <-- (V4) เพิ่ม
-from datetime import datetime, date
+from sqlalchemy import func, and_, case # <-- (V4) เพิ่ม
+from sqlalchemy import event, text, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
+from datetime import datetime, date, timedelta, timezone
+import urllib3
 
 # --- (ใหม่) 1. Import Library ของ Flask-Login และการเข้ารหัส ---
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from itsdangerous import URLSafeSerializer, BadSignature
 
-# --- 1. Import Library ของ LINE Bot SDK ---
-# (ใช้ v3 สำหรับ Webhook)
-from linebot.v3.webhook import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage as V3TextMessage
-from linebot.v3.webhooks import MessageEvent, TextMessageContent
-# (ใช้ v1/v2 สำหรับ Push Message - โค้ดเดิมของคุณ)
-from linebot import LineBotApi
-from linebot.models import TextSendMessage
-from linebot.exceptions import LineBotApiError
+# --- 1. LINE Bot SDK (v3 ทั้ง Webhook, Reply และ Push) ---
+# (ใหม่) import ตอนใช้ครั้งแรกในแต่ละฟังก์ชัน: linebot.v3 ใช้เวลา import ~1 วินาที ไม่ต้องจ่ายตอน worker เริ่ม
 
 
 # --- 1. ตั้งค่าพื้นฐาน ---
-app = Flask(__name__)
+# (ใหม่) Application factory: Flask app ถูกสร้างใน create_app() (ท้ายไฟล์) ส่วน route ทั้งหมดอยู่ใน Blueprint "main"
+# import ไฟล์นี้ไม่แตะฐานข้อมูลและไม่โหลด LINE SDK -> gunicorn worker เริ่มได้เร็วตอน cold start
+bp = Blueprint('main', __name__, cli_group=None)
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-# FIX 3.1: ใช้ Environment Variable สำหรับ DATABASE_URL
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+db = SQLAlchemy()
+
+# (ใหม่) เก็บสิ่งที่เปลี่ยนระหว่าง flush ไว้ใน session.info แล้วทำงานต่อหลัง commit จริงเท่านั้น
+def track_changes_until_commit(info_key, collect, on_commit, on_flush=None):
+    """ลงทะเบียน listener ของ db.session 3 ตัว
+    after_flush: collect(session) -> key ที่เปลี่ยน สะสมใน session.info[info_key] (แล้วเรียก on_flush(keys) ถ้ามี)
+    after_commit: on_commit(keys) ถ้ามี key; ข้าม SAVEPOINT เพราะ after_commit ถูกเรียกตอนปล่อย SAVEPOINT ด้วย
+    after_rollback: ทิ้ง key; rollback แค่ SAVEPOINT ไม่ทิ้ง เพราะของที่ flush ก่อนหน้ายังรอ commit อยู่"""
+    def collect_changes(session, flush_context):
+        changed = session.info.setdefault(info_key, set())
+        changed.update(collect(session))
+        if on_flush is not None:
+            on_flush(changed)
+
+    def run_after_commit(session):
+        if session.in_nested_transaction():
+            return
+        changed = session.info.pop(info_key, None)
+        if changed:
+            on_commit(changed)
+
+    def discard_changes(session):
+        if session.in_nested_transaction():
+            return
+        session.info.pop(info_key, None)
+
+    event.listen(db.session, 'after_flush', collect_changes)
+    event.listen(db.session, 'after_commit', run_after_commit)
+    event.listen(db.session, 'after_rollback', discard_changes)
 
 # --- (ใหม่) 2. ตั้งค่า Flask-Login ---
-app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY')
-
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
 login_manager.login_message = "กรุณาเข้าสู่ระบบเพื่อใช้งานหน้านี้"
 login_manager.login_message_category = "warning"
 
+# (ใหม่) cache ตัวตนของ Admin ที่ login อยู่ (TTL + LRU): ไม่ต้อง query User ทุก request
+# แก้/ลบผู้ใช้ -> ล้าง entry หลัง commit ทันที (session events ด้านล่าง); worker process อื่นเห็นภายใน TTL
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', 30))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 256))
+_user_cache = OrderedDict() # user_id -> (cached_at, UserSnapshot)
+_user_cache_lock = threading.Lock()
+
+class UserSnapshot(UserMixin):
+    """สำเนาอ่านอย่างเดียวของ User สำหรับ current_user (ไม่ผูกกับ db.session)"""
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.full_name = user.full_name
+        self.line_user_id = user.line_user_id
+        self.is_admin = bool(user.is_admin)
+
+    def __repr__(self):
+        return f'<UserSnapshot {self.full_name}>'
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
-# --- (สิ้นสุดส่วนที่เพิ่มใหม่) ---
+    user_id = int(user_id)
+    now = time.monotonic()
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+        if cached and now - cached[0] < USER_CACHE_TTL_SECONDS:
+            _user_cache.move_to_end(user_id)
+            return cached[1]
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    snapshot = UserSnapshot(user)
+    with _user_cache_lock:
+        _user_cache[user_id] = (now, snapshot)
+        _user_cache.move_to_end(user_id)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+    return snapshot
+
+def invalidate_user_cache(user_ids=None):
+    with _user_cache_lock:
+        if user_ids is None:
+            _user_cache.clear()
+        else:
+            for user_id in user_ids:
+                _user_cache.pop(user_id, None)
 
+def _user_cache_changes(session):
+    return {obj.id for obj in list(session.dirty) + list(session.deleted) if isinstance(obj, User)}
+
+# ล้างตอน flush และซ้ำหลัง commit เผื่อมี request อื่นโหลดค่าเก่าเข้า cache ระหว่าง flush กับ commit
+track_changes_until_commit('user_cache_changes', _user_cache_changes,
+                           on_commit=invalidate_user_cache, on_flush=invalidate_user_cache)
+# --- (สิ้นสุดส่วนที่เพิ่มใหม่) ---
 
-# FIX 1: ย้าย db.create_all() มาไว้ตรงนี้
-with app.app_context():
-    db.create_all()
 
 # FIX 3.2: ใช้ Environment Variables สำหรับ LINE Tokens
 YOUR_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
 YOUR_TARGET_GROUP_ID = os.environ.get('LINE_TARGET_GROUP_ID')
 YOUR_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET')
-handler = WebhookHandler(YOUR_CHANNEL_SECRET)
+
+_webhook_parser = None
+
+def get_webhook_parser():
+    global _webhook_parser
+    if _webhook_parser is None:
+        from linebot.v3.webhook import WebhookParser
+        _webhook_parser = WebhookParser(YOUR_CHANNEL_SECRET)
+    return _webhook_parser
 # ===================================================
 
-# --- 1.2 สร้าง Instance ของ LineBotApi (v1/v2) ---
-try:
-    line_bot_api = LineBotApi(YOUR_CHANNEL_ACCESS_TOKEN)
-except Exception as e:
-    print(f"!!! Error initializing LineBotApi (v1): {e}")
-    line_bot_api = None
+# --- 1.2 LINE MessagingApi (v3) ตัวเดียวที่ใช้ร่วมกันทั้ง process ---
+# ใช้ connection pool (keep-alive) ของ urllib3 แทนการสร้าง ApiClient ใหม่ทุกครั้ง
+# PoolManager ของ urllib3 ใช้ข้าม thread ได้อย่างปลอดภัย (client ถูกสร้างและเก็บไว้ใน LineTransport)
+LINE_API_HOST = os.environ.get('LINE_API_HOST') # (ไม่บังคับ) เช่น ชี้ไปที่ LINE stub ตอนทดสอบ
+LINE_CONNECTION_POOL_SIZE = int(os.environ.get('LINE_CONNECTION_POOL_SIZE', 10))
+LINE_REQUEST_TIMEOUT = float(os.environ.get('LINE_REQUEST_TIMEOUT', 10))
+
+# --- 1.2.1 (ใหม่) โหมด async: ยิง LINE พร้อมกันบน event loop กลางของ process ---
+# LINE_ASYNC_MODE=1: ทุก request ไป LINE วิ่งบน event loop 1 ตัว (thread แยก) ด้วย AsyncMessagingApi (aiohttp)
+# fan-out หลายร้อยข้อความค้างพร้อมกันได้โดยไม่ต้องมี thread ต่อข้อความ; จำนวนที่ค้างถูกจำกัดด้วย semaphore
+LINE_ASYNC_MODE = os.environ.get('LINE_ASYNC_MODE', '0') == '1'
+LINE_ASYNC_CONCURRENCY = int(os.environ.get('LINE_ASYNC_CONCURRENCY', 64))
+
+
+class AsyncLineRunner:
+    def __init__(self, concurrency):
+        self.concurrency = max(1, concurrency)
+        self.loop = None
+        self.semaphore = None
+        self.cleanups = [] # coroutine function ที่ต้องรันก่อน process จบ (ปิด client)
+        self.lock = threading.Lock()
+
+    def _ensure_loop(self):
+        # เริ่ม loop เมื่อใช้ครั้งแรก (หลัง gunicorn fork worker แล้ว) ไม่ใช่ตอน import
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                self.semaphore = asyncio.Semaphore(self.concurrency)
+                threading.Thread(target=loop.run_forever, name='line-async', daemon=True).start()
+                self.loop = loop
+                atexit.register(self.close)
+        return self.loop
+
+    def close(self):
+        """ปิด connection ของ aiohttp ก่อน process จบ (เช่น gunicorn หยุด worker)"""
+        for cleanup in self.cleanups:
+            try:
+                self.submit(cleanup()).result(timeout=5)
+            except Exception as e:
+                print(f"ปิด LINE async client ไม่สำเร็จ: {e}")
+
+    def submit(self, coro):
+        """ส่ง coroutine ไปรันบน loop -> concurrent.futures.Future (ไม่รอ)"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run(self, coro):
+        """รัน coroutine บน loop แล้วรอผล (เรียกจาก thread ปกติ ห้ามเรียกจากบน loop)"""
+        return self.submit(coro).result()
+
+    def gather(self, coros):
+        """รันทุก coroutine พร้อมกัน -> ผลลัพธ์ตามลำดับ (exception ถูกคืนเป็นค่า ไม่ถูก raise)"""
+        async def _gather():
+            return await asyncio.gather(*coros, return_exceptions=True)
+        return self.run(_gather())
+
+
+line_async_runner = AsyncLineRunner(LINE_ASYNC_CONCURRENCY)
+
+# --- 1.3 (ใหม่) LINE transport กลาง: rate limit + retry + circuit breaker ---
+# ทุกจุดที่ push LINE ต้องผ่าน notification_transport (1.4) เพื่อไม่ให้ชน quota ของ channel
+# และไม่ทิ้งข้อความเมื่อ LINE ตอบ 429/5xx ชั่วคราว
+# LINE_RATE_LIMIT_PER_SEC / _BURST คือ quota ของทั้ง channel: token bucket อยู่แยกในแต่ละ process
+# จึงแบ่งเท่าๆ กันตามจำนวน worker (gunicorn.conf.py ตั้ง LINE_RATE_LIMIT_WORKERS ให้ตรงกับ workers เอง)
+LINE_RATE_LIMIT_WORKERS = max(1, int(os.environ.get('LINE_RATE_LIMIT_WORKERS') or os.environ.get('WEB_CONCURRENCY') or 1))
+LINE_CHANNEL_RATE_LIMIT_PER_SEC = float(os.environ.get('LINE_RATE_LIMIT_PER_SEC', 2000))
+LINE_CHANNEL_RATE_LIMIT_BURST = int(os.environ.get('LINE_RATE_LIMIT_BURST', LINE_CHANNEL_RATE_LIMIT_PER_SEC))
+LINE_RATE_LIMIT_PER_SEC = LINE_CHANNEL_RATE_LIMIT_PER_SEC / LINE_RATE_LIMIT_WORKERS # ส่วนของ process นี้
+LINE_RATE_LIMIT_BURST = max(1, LINE_CHANNEL_RATE_LIMIT_BURST // LINE_RATE_LIMIT_WORKERS)
+LINE_RETRY_MAX_ATTEMPTS = int(os.environ.get('LINE_RETRY_MAX_ATTEMPTS', 4))
+LINE_RETRY_BASE_DELAY = float(os.environ.get('LINE_RETRY_BASE_DELAY', 0.5))
+LINE_RETRY_MAX_DELAY = float(os.environ.get('LINE_RETRY_MAX_DELAY', 30))
+LINE_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('LINE_CIRCUIT_FAILURE_THRESHOLD', 5))
+LINE_CIRCUIT_RESET_SECONDS = float(os.environ.get('LINE_CIRCUIT_RESET_SECONDS', 30))
+
+
+class LineSendError(Exception):
+    """ส่ง LINE ไม่สำเร็จหลังจาก retry ครบแล้ว (หรือเป็น error ที่ retry ไม่ได้)"""
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class LineCircuitOpenError(LineSendError):
+    """LINE ล่มต่อเนื่อง -> ปฏิเสธทันทีโดยไม่ยิง request"""
+
+
+class NotificationTransport(ABC):
+    """ช่องทางส่งข้อความของแอป: ทุกจุดที่ส่ง LINE เรียกผ่าน notification_transport เท่านั้น
+    ส่งไม่สำเร็จต้อง raise LineSendError (LineCircuitOpenError ถ้าปฏิเสธโดยไม่ได้ส่ง)
+    backend ที่ขาด method ใด method หนึ่งจะสร้าง instance ไม่ได้ (TypeError) แทนที่จะพังตอนส่งครั้งแรก"""
+    name = None
+
+    @abstractmethod
+    def push_text(self, to, text):
+        ...
+
+    @abstractmethod
+    def reply_text(self, reply_token, text):
+        ...
+
+    @abstractmethod
+    async def push_text_async(self, to, text):
+        ...
+
+    @abstractmethod
+    async def reply_text_async(self, reply_token, text):
+        ...
+
+    def stats(self):
+        return {'transport': self.name}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self):
+        """หยิบ token 1 อัน -> 0 ถ้าได้แล้ว หรือเวลาที่ต้องรอก่อนลองใหม่ (วินาที)"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """รอจนได้ token แล้วคืนค่าเวลาที่ต้องรอ (วินาที)"""
+        waited = 0.0
+        while (wait := self._take()) > 0:
+            time.sleep(wait)
+            waited += wait
+        return waited
+
+    async def acquire_async(self):
+        waited = 0.0
+        while (wait := self._take()) > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+        return waited
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.half_open_trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                return 'half_open'
+            return 'open'
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            # half-open: ให้ผ่านแค่ทีละ 1 request เพื่อทดสอบว่า LINE กลับมาแล้ว
+            if self.half_open_trial:
+                return False
+            self.half_open_trial = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.half_open_trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.half_open_trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.half_open_trial = False
+
+
+def _line_error_status(error):
+    return getattr(error, 'status', None)
+
+def _line_error_message(error):
+    try:
+        return json.loads(error.body)['message']
+    except (AttributeError, TypeError, ValueError, KeyError):
+        return getattr(error, 'reason', None) or str(error)
+
+def _line_header(error, name):
+    headers = getattr(error, 'headers', None) or {}
+    for key, value in dict(headers).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+def _line_retry_after(error):
+    value = _line_header(error, 'Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+class LineTransport(NotificationTransport):
+    """ส่งผ่าน LINE Messaging API (หรือ LINE stub ที่ host อื่น) ด้วย rate limit / retry / circuit breaker"""
+    name = 'line'
+
+    def __init__(self, host, access_token, bucket, breaker, max_attempts, base_delay, max_delay):
+        self.host = host
+        self.access_token = access_token
+        self._api = None
+        self._api_lock = threading.Lock()
+        self._async_api = None
+        self.bucket = bucket
+        self.breaker = breaker
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counters = {
+            'calls': 0, 'succeeded': 0, 'failed': 0,
+            'throttled': 0,        # ต้องรอ token bucket ฝั่งเรา
+            'rate_limited': 0,     # LINE ตอบ 429
+            'retried': 0,
+            'circuit_rejected': 0,
+        }
+        self.counters_lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        with self.counters_lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self.counters_lock:
+            data = dict(self.counters)
+        data['transport'] = self.name
+        data['circuit_state'] = self.breaker.state
+        return data
+
+    def _configuration(self, pool_size):
+        from linebot.v3.messaging import Configuration
+        configuration = Configuration(access_token=self.access_token, host=self.host)
+        configuration.connection_pool_maxsize = pool_size
+        return configuration
+
+    def get_api(self):
+        """MessagingApi (sync) ตัวเดียวของ transport นี้"""
+        if self._api is None:
+            with self._api_lock:
+                if self._api is None:
+                    from linebot.v3.messaging import ApiClient, MessagingApi
+                    self._api = MessagingApi(ApiClient(self._configuration(LINE_CONNECTION_POOL_SIZE)))
+        return self._api
+
+    def get_async_api(self):
+        """AsyncMessagingApi ตัวเดียวของ transport นี้ (เรียกจาก coroutine บน line_async_runner เท่านั้น)"""
+        if self._async_api is None:
+            from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi
+            self._async_api = AsyncMessagingApi(AsyncApiClient(self._configuration(line_async_runner.concurrency)))
+            line_async_runner.cleanups.append(self._async_api.api_client.close)
+        return self._async_api
+
+    def _backoff(self, attempt, retry_after=None):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay) # jitter
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _before_attempt(self):
+        if not self.breaker.allow():
+            self._count('circuit_rejected')
+            self._count('failed')
+            raise LineCircuitOpenError("LINE API ไม่พร้อมใช้งานชั่วคราว (circuit open)")
+
+    def _succeeded(self, result):
+        self.breaker.record_success()
+        self._count('succeeded')
+        return result
+
+    def _unexpected_failure(self):
+        # error อื่นๆ (serialize ไม่ได้, runner ปิด, ถูก cancel): ต้องปล่อย half-open trial เสมอ
+        # ไม่งั้น allow() จะคืน False ตลอดไปจน process restart
+        self.breaker.record_failure()
+        self._count('failed')
+
+    def _retry_delay(self, error, attempt):
+        """ตัดสินใจหลัง error: คืนเวลาที่ต้องรอก่อน retry, None ถ้า LINE รับไปแล้ว หรือ raise LineSendError"""
+        status_code = _line_error_status(error)
+        if status_code == 409 and _line_header(error, 'X-Line-Accepted-Request-Id'):
+            # retry key เดิมถูก LINE รับไปแล้วในรอบก่อน -> ถือว่าส่งสำเร็จ
+            return None
+        retryable = status_code is None or status_code == 429 or status_code >= 500
+        if status_code == 429:
+            self._count('rate_limited')
+        if not retryable:
+            # 4xx อื่นๆ (เช่น user block bot) ไม่ใช่ปัญหาของ LINE -> ไม่นับเข้า circuit
+            self.breaker.record_success()
+            self._count('failed')
+            raise LineSendError(_line_error_message(error), status_code) from error
+
+        self.breaker.record_failure()
+        retry_after = _line_retry_after(error)
+        last_attempt = attempt == self.max_attempts - 1
+        if last_attempt or (retry_after is not None and retry_after > self.max_delay):
+            self._count('failed')
+            raise LineSendError(_line_error_message(error), status_code) from error
+
+        self._count('retried')
+        return self._backoff(attempt, retry_after)
+
+    def call(self, func, *args, **kwargs):
+        """เรียก LINE API ผ่าน rate limit / retry / circuit breaker"""
+        from linebot.v3.messaging import ApiException
+        self._count('calls')
+        for attempt in range(self.max_attempts):
+            self._before_attempt()
+            try:
+                if self.bucket.acquire() > 0:
+                    self._count('throttled')
+                result = func(*args, **kwargs)
+            except (ApiException, urllib3.exceptions.HTTPError) as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    return self._succeeded(None)
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self._unexpected_failure()
+                raise
+            return self._succeeded(result)
+
+    async def call_async(self, func, *args, **kwargs):
+        """เหมือน call() แต่ func เป็น coroutine function ของ AsyncMessagingApi (รันบน line_async_runner)"""
+        import aiohttp
+        from linebot.v3.messaging import ApiException
+        self._count('calls')
+        for attempt in range(self.max_attempts):
+            self._before_attempt()
+            try:
+                if await self.bucket.acquire_async() > 0:
+                    self._count('throttled')
+                async with line_async_runner.semaphore:
+                    result = await func(*args, **kwargs)
+            except (ApiException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    return self._succeeded(None)
+                await asyncio.sleep(delay)
+                continue
+            except BaseException: # รวม CancelledError
+                self._unexpected_failure()
+                raise
+            return self._succeeded(result)
+
+    def push_text(self, to, text):
+        if LINE_ASYNC_MODE:
+            return line_async_runner.run(self.push_text_async(to, text))
+        from linebot.v3.messaging import PushMessageRequest, TextMessage as V3TextMessage
+        # retry key เดียวกันทุกรอบ retry -> LINE ไม่ส่งซ้ำถ้ารอบก่อนสำเร็จไปแล้ว
+        return self.call(
+            self.get_api().push_message,
+            PushMessageRequest(to=to, messages=[V3TextMessage(text=text)]),
+            x_line_retry_key=str(uuid.uuid4()),
+            _request_timeout=LINE_REQUEST_TIMEOUT
+        )
 
-# --- 1.5 ฟังก์ชันสำหรับส่ง LINE (Messaging API - v1/v2) ---
+    def reply_text(self, reply_token, text):
+        if LINE_ASYNC_MODE:
+            return line_async_runner.run(self.reply_text_async(reply_token, text))
+        from linebot.v3.messaging import ReplyMessageRequest, TextMessage as V3TextMessage
+        return self.call(
+            self.get_api().reply_message,
+            ReplyMessageRequest(reply_token=reply_token, messages=[V3TextMessage(text=text)]),
+            _request_timeout=LINE_REQUEST_TIMEOUT
+        )
+
+    async def push_text_async(self, to, text):
+        from linebot.v3.messaging import PushMessageRequest, TextMessage as V3TextMessage
+        return await self.call_async(
+            self.get_async_api().push_message,
+            PushMessageRequest(to=to, messages=[V3TextMessage(text=text)]),
+            x_line_retry_key=str(uuid.uuid4()),
+            _request_timeout=LINE_REQUEST_TIMEOUT
+        )
+
+    async def reply_text_async(self, reply_token, text):
+        from linebot.v3.messaging import ReplyMessageRequest, TextMessage as V3TextMessage
+        return await self.call_async(
+            self.get_async_api().reply_message,
+            ReplyMessageRequest(reply_token=reply_token, messages=[V3TextMessage(text=text)]),
+            _request_timeout=LINE_REQUEST_TIMEOUT
+        )
+
+
+class RecordingTransport(NotificationTransport):
+    """เก็บข้อความไว้ในหน่วยความจำแทนการส่งจริง (dev / load test โดยไม่แตะ LINE)"""
+    name = 'memory'
+
+    def __init__(self, max_messages=10000):
+        self.messages = deque(maxlen=max_messages) # ข้อความล่าสุด: {'kind', 'to', 'text', 'sent_at'}
+        self.failures = {} # ผู้รับหรือ reply token -> LineSendError ที่จะ raise แทนการส่ง (จำลอง LINE error)
+        self.counters = {'calls': 0, 'succeeded': 0, 'failed': 0}
+        self.lock = threading.Lock()
+
+    def _record(self, kind, to, text):
+        with self.lock:
+            self.counters['calls'] += 1
+            error = self.failures.get(to)
+            if error is not None:
+                self.counters['failed'] += 1
+                raise error
+            self.messages.append({'kind': kind, 'to': to, 'text': text, 'sent_at': time.time()})
+            self.counters['succeeded'] += 1
+
+    def push_text(self, to, text):
+        self._record('push', to, text)
+
+    def reply_text(self, reply_token, text):
+        self._record('reply', reply_token, text)
+
+    async def push_text_async(self, to, text):
+        self._record('push', to, text)
+
+    async def reply_text_async(self, reply_token, text):
+        self._record('reply', reply_token, text)
+
+    def clear(self):
+        with self.lock:
+            self.messages.clear()
+            self.failures.clear()
+            self.counters = dict.fromkeys(self.counters, 0)
+
+    def stats(self):
+        with self.lock:
+            data = dict(self.counters)
+        data['transport'] = self.name
+        data['recorded'] = len(self.messages)
+        return data
+
+
+# --- 1.4 (ใหม่) เลือก backend ของการส่งข้อความ ---
+# NOTIFICATION_TRANSPORT=line   (ค่าเริ่มต้น) LINE จริง
+#                      =memory เก็บข้อความไว้ในหน่วยความจำ ไม่ส่งจริง
+#                      =stub   LINE stub บนเครื่อง (python bench/fake_line_server.py) ที่ LINE_STUB_URL
+# ทั้ง line และ stub ผ่าน rate limit / retry / circuit breaker ตัวเดียวกัน จึงใช้ stub จูนค่าพวกนี้ได้
+NOTIFICATION_TRANSPORT = os.environ.get('NOTIFICATION_TRANSPORT', 'line')
+LINE_STUB_URL = os.environ.get('LINE_STUB_URL', 'http://127.0.0.1:8808')
+
+def make_notification_transport(name):
+    if name == 'memory':
+        return RecordingTransport()
+    if name == 'line':
+        host, access_token = LINE_API_HOST, YOUR_CHANNEL_ACCESS_TOKEN
+    elif name == 'stub':
+        host, access_token = LINE_STUB_URL, 'stub-token' # ไม่ส่ง token จริงออกไปที่ stub
+    else:
+        raise ValueError(f"ไม่รู้จัก NOTIFICATION_TRANSPORT={name!r} (ใช้ได้: line, memory, stub)")
+    return LineTransport(
+        host, access_token,
+        TokenBucket(LINE_RATE_LIMIT_PER_SEC, LINE_RATE_LIMIT_BURST),
+        CircuitBreaker(LINE_CIRCUIT_FAILURE_THRESHOLD, LINE_CIRCUIT_RESET_SECONDS),
+        LINE_RETRY_MAX_ATTEMPTS, LINE_RETRY_BASE_DELAY, LINE_RETRY_MAX_DELAY
+    )
+
+notification_transport = make_notification_transport(NOTIFICATION_TRANSPORT)
+
+# --- 1.5 ฟังก์ชันสำหรับส่ง LINE (Messaging API - v3) ---
 def send_line_push_message(message_text):
-    if not line_bot_api:
-        print("ไม่สามารถส่ง LINE ได้: LineBotApi (v1) ไม่ได้ถูกตั้งค่า")
-        return False
     if not YOUR_TARGET_GROUP_ID:
         print("ไม่สามารถส่ง LINE ได้: กรุณาตั้งค่า LINE_TARGET_GROUP_ID")
         return False
+    if LINE_ASYNC_MODE:
+        # ไม่ให้ request รอข้อความเข้ากลุ่ม: ส่งบน event loop แล้วบันทึกผลเมื่อเสร็จ
+        future = line_async_runner.submit(notification_transport.push_text_async(YOUR_TARGET_GROUP_ID, message_text))
+        future.add_done_callback(_log_group_push_result)
+        return True
     try:
-        message = TextSendMessage(text=message_text)
-        line_bot_api.push_message(YOUR_TARGET_GROUP_ID, messages=message)
+        notification_transport.push_text(YOUR_TARGET_GROUP_ID, message_text)
         print(f"ส่ง LINE Push Message เข้ากลุ่มสำเร็จ!")
         return True
-    except LineBotApiError as e:
-        print(f"ส่ง LINE Push Message ไม่สำเร็จ: {e.code} {e.message}")
+    except LineSendError as e:
+        print(f"ส่ง LINE Push Message ไม่สำเร็จ: {e.status_code} {e.message}")
         return False
     except Exception as e:
-        print(f"เกิดข้อผิดพลาดในการส่ง LINE (v1): {e}")
+        print(f"เกิดข้อผิดพลาดในการส่ง LINE (v3): {e}")
         return False
 
+def _log_group_push_result(future):
+    error = future.exception()
+    if error is None:
+        print(f"ส่ง LINE Push Message เข้ากลุ่มสำเร็จ!")
+    elif isinstance(error, LineSendError):
+        print(f"ส่ง LINE Push Message ไม่สำเร็จ: {error.status_code} {error.message}")
+    else:
+        print(f"เกิดข้อผิดพลาดในการส่ง LINE (v3): {error}")
+
 # --- (ใหม่) 1.6 Webhook สำหรับ "รับ" ข้อความจาก LINE (v3) ---
-@app.route("/callback", methods=['POST'])
+# LINE_WEBHOOK_ASYNC=1: ตรวจ signature แล้วตอบ 200 ทันที ส่วน event ถูกประมวลผลโดย worker pool
+LINE_WEBHOOK_ASYNC = os.environ.get('LINE_WEBHOOK_ASYNC', '0') == '1'
+LINE_WEBHOOK_WORKERS = int(os.environ.get('LINE_WEBHOOK_WORKERS', 4))
+LINE_WEBHOOK_QUEUE_SIZE = int(os.environ.get('LINE_WEBHOOK_QUEUE_SIZE', 1000))
+# กัน LINE ส่ง event ซ้ำ (redelivery) ด้วย webhookEventId
+LINE_WEBHOOK_DEDUP_SIZE = int(os.environ.get('LINE_WEBHOOK_DEDUP_SIZE', 10000))
+LINE_WEBHOOK_DEDUP_TTL_SECONDS = int(os.environ.get('LINE_WEBHOOK_DEDUP_TTL_SECONDS', 24 * 3600))
+LINE_WEBHOOK_DEDUP_DB = os.environ.get('LINE_WEBHOOK_DEDUP_DB', '0') == '1'
+
+webhook_queue = queue.Queue(maxsize=LINE_WEBHOOK_QUEUE_SIZE)
+webhook_workers = []
+webhook_workers_lock = threading.Lock()
+webhook_stats = {
+    'enqueued': 0, 'processed': 0, 'failed': 0,
+    'processed_inline': 0,   # queue เต็ม -> ประมวลผลใน request แทน
+    'duplicates': 0,         # event ที่เคยประมวลผลแล้ว (ข้าม)
+    'wait_ms_total': 0.0, 'wait_ms_max': 0.0,
+    'process_ms_total': 0.0, 'process_ms_max': 0.0,
+}
+webhook_stats_lock = threading.Lock()
+
+def _record_webhook_timing(wait_ms, process_ms, ok):
+    with webhook_stats_lock:
+        webhook_stats['processed' if ok else 'failed'] += 1
+        webhook_stats['wait_ms_total'] += wait_ms
+        webhook_stats['wait_ms_max'] = max(webhook_stats['wait_ms_max'], wait_ms)
+        webhook_stats['process_ms_total'] += process_ms
+        webhook_stats['process_ms_max'] = max(webhook_stats['process_ms_max'], process_ms)
+
+class WebhookEventDedup:
+    """เก็บ webhookEventId ที่ประมวลผลแล้ว: LRU ใน memory + (ไม่บังคับ) ตารางใน DB ที่ใช้ร่วมกันทุก worker"""
+    def __init__(self, max_size, ttl_seconds, use_db):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.use_db = use_db
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+        self.db_inserts = 0
+
+    def claim(self, event_id):
+        """คืน True ถ้าเป็น event ใหม่ (และจองไว้แล้ว), False ถ้าเคยเห็นแล้ว"""
+        now = time.monotonic()
+        with self.lock:
+            seen_at = self.seen.get(event_id)
+            if seen_at is not None and now - seen_at < self.ttl_seconds:
+                self.seen.move_to_end(event_id)
+                return False
+            self.seen[event_id] = now
+            self.seen.move_to_end(event_id)
+            while len(self.seen) > self.max_size:
+                self.seen.popitem(last=False)
+
+        if self.use_db:
+            try:
+                claimed = self._claim_in_db(event_id)
+            except Exception:
+                # จองใน DB ไม่สำเร็จ (เช่น DB ล่ม): ห้ามค้างใน memory ไม่งั้น redelivery ของ LINE จะถูกมองว่าซ้ำ
+                db.session.rollback()
+                with self.lock:
+                    self.seen.pop(event_id, None)
+                raise
+            if not claimed:
+                return False
+            self._purge_expired()
+        return True
+
+    def release(self, event_id):
+        """ประมวลผลไม่สำเร็จ -> ลบออกเพื่อให้ redelivery รอบถัดไปได้ทำงาน"""
+        with self.lock:
+            self.seen.pop(event_id, None)
+        if self.use_db:
+            try:
+                ProcessedWebhookEvent.query.filter_by(event_id=event_id).delete()
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f"Error releasing webhook event {event_id}: {e}")
+
+    def _claim_in_db(self, event_id):
+        try:
+            db.session.add(ProcessedWebhookEvent(event_id=event_id))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        return True
+
+    def _purge_expired(self):
+        """ลบแถวที่หมดอายุเป็นระยะๆ ไม่ต้องมี cron แยก (พลาดได้: event ถูกจองไปแล้ว ลบรอบถัดไปแทน)"""
+        with self.lock:
+            self.db_inserts += 1
+            purge = self.db_inserts % 500 == 0
+        if not purge:
+            return
+        try:
+            expired_before = datetime.utcnow() - timedelta(seconds=self.ttl_seconds)
+            ProcessedWebhookEvent.query.filter(ProcessedWebhookEvent.processed_at < expired_before).delete()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error purging expired webhook events: {e}")
+
+
+webhook_dedup = WebhookEventDedup(LINE_WEBHOOK_DEDUP_SIZE, LINE_WEBHOOK_DEDUP_TTL_SECONDS, LINE_WEBHOOK_DEDUP_DB)
+
+def handle_webhook_events(events):
+    """ข้าม event ที่เคยทำไปแล้ว (ก่อนแตะ DB ส่วนอื่น) แล้วประมวลผลข้อความทั้ง payload ในครั้งเดียว"""
+    from linebot.v3.webhooks import MessageEvent, TextMessageContent
+    message_events = []
+    claimed_ids = []
+    try:
+        for event in events:
+            event_id = getattr(event, 'webhook_event_id', None)
+            if event_id:
+                if not webhook_dedup.claim(event_id):
+                    with webhook_stats_lock:
+                        webhook_stats['duplicates'] += 1
+                    continue
+                claimed_ids.append(event_id)
+            if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+                message_events.append(event)
+
+        if message_events:
+            handle_message_events(message_events)
+    except Exception:
+        # พลาดตรงไหนก็ตาม: ปล่อย event ที่จองไว้ทั้งหมดให้ redelivery รอบถัดไปได้ทำงาน
+        for event_id in claimed_ids:
+            webhook_dedup.release(event_id)
+        raise
+
+def _process_webhook_body(app, body, signature, base_url, enqueued_at):
+    started_at = time.monotonic()
+    ok = True
+    # ต้องมี request context เพื่อให้ url_for(_external=True) สร้างลิงก์ได้เหมือนตอนอยู่ใน request
+    with app.test_request_context('/callback', base_url=base_url):
+        try:
+            handle_webhook_events(get_webhook_parser().parse(body, signature))
+        except Exception as e:
+            ok = False
+            app.logger.error(f"Error processing LINE webhook events: {e}")
+    _record_webhook_timing(
+        (started_at - enqueued_at) * 1000,
+        (time.monotonic() - started_at) * 1000,
+        ok
+    )
+
+def _webhook_worker():
+    while True:
+        app, body, signature, base_url, enqueued_at = webhook_queue.get()
+        try:
+            _process_webhook_body(app, body, signature, base_url, enqueued_at)
+        finally:
+            webhook_queue.task_done()
+
+def _ensure_webhook_workers():
+    # เริ่ม worker เมื่อมี webhook แรกเข้ามา (ไม่เริ่มตอนรัน CLI / import)
+    with webhook_workers_lock:
+        while len(webhook_workers) < LINE_WEBHOOK_WORKERS:
+            worker = threading.Thread(target=_webhook_worker, name=f'line-webhook-{len(webhook_workers)}', daemon=True)
+            worker.start()
+            webhook_workers.append(worker)
+
+@bp.route("/callback", methods=['POST'])
 def callback():
+    from linebot.v3.exceptions import InvalidSignatureError
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    current_app.logger.info("Request body: " + body)
+
+    if LINE_WEBHOOK_ASYNC:
+        if not get_webhook_parser().signature_validator.validate(body, signature):
+            current_app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
+            abort(400)
+        _ensure_webhook_workers()
+        try:
+            webhook_queue.put_nowait((current_app._get_current_object(), body, signature, request.host_url, time.monotonic()))
+            with webhook_stats_lock:
+                webhook_stats['enqueued'] += 1
+        except queue.Full:
+            # queue เต็ม: ประมวลผลเองใน request ดีกว่าทิ้ง event
+            with webhook_stats_lock:
+                webhook_stats['processed_inline'] += 1
+            _process_webhook_body(current_app._get_current_object(), body, signature, request.host_url, time.monotonic())
+        return 'OK'
+
     try:
-        handler.handle(body, signature)
+        events = get_webhook_parser().parse(body, signature)
     except InvalidSignatureError:
-        app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
+        current_app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
+    handle_webhook_events(events)
     return 'OK'
 
 # --- 2. สร้างโมเดลฐานข้อมูล ---
@@ -126,7 +888,24 @@ class OTSchedule(db.Model):
     ot_date = db.Column(db.Date, nullable=False, unique=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+ACTIVE_DELEGATION_STATUSES = ('delegated', 'sub_confirmed')
+# ใช้ร่วมกันทั้ง query หาคนแทน, query plan check และ partial unique index (ห้ามเขียนสถานะซ้ำที่อื่น)
+ACTIVE_DELEGATION_WHERE = "response_status IN ({})".format(', '.join(f"'{status}'" for status in ACTIVE_DELEGATION_STATUSES))
+
 class OTResponse(db.Model):
+    # ตรงกับ migration 1 (ฐานข้อมูลใหม่ได้ index เหล่านี้จาก create_all เลย)
+    __table_args__ = (
+        db.Index('ix_ot_response_schedule_status', 'schedule_id', 'response_status'),
+        db.Index('ix_ot_response_schedule_delegated', 'schedule_id', 'delegated_to_user_id'),
+        db.Index('ix_ot_response_primary_status', 'primary_user_id', 'response_status'),
+        db.Index('ix_ot_response_delegated_user', 'delegated_to_user_id',
+                 postgresql_where=db.text('delegated_to_user_id IS NOT NULL'),
+                 sqlite_where=db.text('delegated_to_user_id IS NOT NULL')),
+        # migration 2: ตัวแทน 1 คนถูกเลือกได้ครั้งเดียวต่อวัน (กันสองคนมอบสิทธิ์ให้คนเดียวกันพร้อมกัน)
+        db.Index('uq_ot_response_active_delegation', 'schedule_id', 'delegated_to_user_id', unique=True,
+                 postgresql_where=db.text(ACTIVE_DELEGATION_WHERE),
+                 sqlite_where=db.text(ACTIVE_DELEGATION_WHERE)),
+    )
     id = db.Column(db.Integer, primary_key=True)
     token = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
     schedule_id = db.Column(db.Integer, db.ForeignKey('ot_schedule.id'), nullable=False)
@@ -134,25 +913,635 @@ class OTResponse(db.Model):
     response_status = db.Column(db.String(50), default='pending') # pending, confirmed, declined_admin, delegated, sub_confirmed, sub_declined
     delegated_to_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     let_admin_decide = db.Column(db.Boolean, default=False)
+    # (ใหม่) UPDATE ทุกครั้งมี WHERE version = ค่าที่อ่านมา: ถ้ามีคนแก้ไปก่อนจะได้ StaleDataError แทนการเขียนทับ
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     schedule = db.relationship('OTSchedule', backref=db.backref('responses', lazy=True, cascade="all, delete-orphan")) # Add cascade
     primary_user = db.relationship('User', foreign_keys=[primary_user_id])
     delegated_user = db.relationship('User', foreign_keys=[delegated_to_user_id])
 
+    __mapper_args__ = {'version_id_col': version}
+
+    @property
+    def survey_token(self):
+        return make_survey_token(self.id, self.schedule_id)
+
+# (ใหม่) Outbox สำหรับข้อความ LINE ที่รอส่ง (1 แถว = 1 ผู้รับ)
+class LineOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(36), nullable=False, index=True)
+    schedule_id = db.Column(db.Integer, db.ForeignKey('ot_schedule.id', ondelete='SET NULL'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    recipient_name = db.Column(db.String(120), nullable=False)
+    line_user_id = db.Column(db.String(100), nullable=True)
+    message_text = db.Column(db.Text, nullable=False)
+    survey_link = db.Column(db.String(500), nullable=True)
+    status = db.Column(db.String(20), default='queued', nullable=False, index=True) # queued, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# (ใหม่) ยอด OT ที่ยืนยันแล้ว สรุปล่วงหน้าราย "พนักงาน x เดือน x สัปดาห์ (ISO)" สำหรับหน้ารายงาน
+# 1 แถว = ช่วงวันที่อยู่ทั้งในเดือนและสัปดาห์เดียวกัน -> รายเดือน/รายสัปดาห์ รวมแถวได้ตรงๆ
+class OTTally(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'year', 'month', 'iso_year', 'iso_week', name='uq_ot_tally_bucket'),
+        db.Index('ix_ot_tally_year_month', 'year', 'month'),
+        db.Index('ix_ot_tally_iso_week', 'iso_year', 'iso_week'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    iso_year = db.Column(db.Integer, nullable=False)
+    iso_week = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    dates = db.Column(db.Text, nullable=False, default='') # YYYY-MM-DD คั่นด้วย , (เรียงแล้ว)
+
+# (ใหม่) บันทึกการเปลี่ยนสถานะของ OTResponse (เพิ่มอย่างเดียว ไม่แก้/ลบ) ให้ระบบภายนอกดึงไป sync ต่อ
+# id ที่เพิ่มขึ้นเรื่อยๆ ใช้เป็น cursor ของ /api/changes
+class OTResponseChange(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    response_id = db.Column(db.Integer, nullable=False, index=True) # ไม่ผูก FK: response อาจถูกลบไปพร้อมตาราง
+    schedule_id = db.Column(db.Integer, nullable=False)
+    ot_date = db.Column(db.Date, nullable=False)
+    primary_user_id = db.Column(db.Integer, nullable=False)
+    old_status = db.Column(db.String(20), nullable=False)
+    new_status = db.Column(db.String(20), nullable=False) # 'deleted' = ตารางถูกลบ
+    old_delegated_to_user_id = db.Column(db.Integer, nullable=True)
+    new_delegated_to_user_id = db.Column(db.Integer, nullable=True)
+    changed_by_user_id = db.Column(db.Integer, nullable=True) # Admin ที่กด หรือพนักงานที่ตอบผ่าน Survey
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False) # เวลา commit (ดู _insert_pending_response_changes)
+
+    def to_dict(self):
+        return {
+            "cursor": str(self.id),
+            "response_id": self.response_id,
+            "schedule_id": self.schedule_id,
+            "ot_date": self.ot_date.strftime('%Y-%m-%d'),
+            "primary_user_id": self.primary_user_id,
+            "old_status": self.old_status,
+            "new_status": self.new_status,
+            "old_delegated_to_user_id": self.old_delegated_to_user_id,
+            "new_delegated_to_user_id": self.new_delegated_to_user_id,
+            "changed_by_user_id": self.changed_by_user_id,
+            "changed_at": self.changed_at.strftime('%Y-%m-%dT%H:%M:%SZ')
+        }
+
+# (ใหม่) เวอร์ชันของ schema ที่ migrate แล้ว (ดู run_migrations)
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# (ใหม่) webhookEventId ที่ประมวลผลแล้ว (ใช้เมื่อ LINE_WEBHOOK_DEDUP_DB=1)
+class ProcessedWebhookEvent(db.Model):
+    event_id = db.Column(db.String(64), primary_key=True)
+    processed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+
+# --- 2.0 (ใหม่) Schema migration แบบมีเวอร์ชัน ---
+# db.create_all() สร้างได้แค่ตารางใหม่ ไม่แก้ตารางที่มีอยู่แล้ว: การเปลี่ยน schema ของตารางเดิมเพิ่มเป็น migration ที่นี่
+# ทุก migration ต้องรันซ้ำได้ (IF NOT EXISTS) เพราะฐานข้อมูลใหม่อาจมีของนั้นจาก create_all แล้ว
+MIGRATION_LOCK_ID = 7210416 # pg_advisory_lock: ให้ migrate ได้ทีละ process
+# (ใหม่) ปกติรันผ่าน `flask db-upgrade` ครั้งเดียวก่อนเริ่ม server; =1 ให้ create_app() ทำให้ (สะดวกตอนพัฒนา)
+RUN_MIGRATIONS_ON_STARTUP = os.environ.get('RUN_MIGRATIONS_ON_STARTUP', '0') == '1'
+
+def create_index(conn, name, table, columns, where=None, unique=False):
+    """CREATE INDEX ที่ไม่ล็อกการเขียนบน PostgreSQL (CONCURRENTLY ต้องรันนอก transaction)"""
+    concurrently = ''
+    if conn.dialect.name == 'postgresql':
+        concurrently = 'CONCURRENTLY '
+        # ถ้าเคยสร้างแบบ CONCURRENTLY แล้วล้มกลางทาง index จะค้างเป็น INVALID: ลบทิ้งแล้วสร้างใหม่
+        invalid = conn.execute(text(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {'name': name}).first()
+        if invalid:
+            conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+    sql = f'CREATE {"UNIQUE " if unique else ""}INDEX {concurrently}IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'
+    if where:
+        sql += f' WHERE {where}'
+    conn.execute(text(sql))
+
+def _migration_ot_response_indexes(conn):
+    # ตาราง OT / สรุปสถานะ / ส่งเตือนที่ยังไม่ตอบ
+    create_index(conn, 'ix_ot_response_schedule_status', 'ot_response', ['schedule_id', 'response_status'])
+    # ตรวจตัวแทนซ้ำ + find_substitute_candidates
+    create_index(conn, 'ix_ot_response_schedule_delegated', 'ot_response', ['schedule_id', 'delegated_to_user_id'])
+    # คำสั่ง LINE "OT ที่ยังไม่ตอบ" + delete_user
+    create_index(conn, 'ix_ot_response_primary_status', 'ot_response', ['primary_user_id', 'response_status'])
+    # delete_user (ส่วนใหญ่ไม่มีตัวแทน จึงเก็บเฉพาะแถวที่มี)
+    create_index(conn, 'ix_ot_response_delegated_user', 'ot_response', ['delegated_to_user_id'],
+                 where='delegated_to_user_id IS NOT NULL')
+
+def _migration_ot_response_concurrency(conn):
+    if 'version' not in {column['name'] for column in db.inspect(conn).get_columns('ot_response')}:
+        # มีค่า default คงที่: PostgreSQL 11+ เพิ่มได้ทันทีโดยไม่ rewrite ตาราง
+        conn.execute(text('ALTER TABLE ot_response ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+
+    # ข้อมูลเก่าที่เคยชนกันไปแล้วต้องแก้ก่อน ไม่อย่างนั้นสร้าง unique index ไม่ได้
+    duplicates = conn.execute(text(
+        f"SELECT schedule_id, delegated_to_user_id, COUNT(*) FROM ot_response "
+        f"WHERE {ACTIVE_DELEGATION_WHERE} GROUP BY schedule_id, delegated_to_user_id HAVING COUNT(*) > 1"
+    )).all()
+    if duplicates:
+        raise RuntimeError(
+            "มีตัวแทนซ้ำในตาราง OT เดียวกัน (schedule_id, delegated_to_user_id, จำนวน): "
+            f"{duplicates} - ให้ Admin ปฏิเสธตัวแทนที่ซ้ำใน Dashboard ก่อน แล้วรัน db-upgrade อีกครั้ง"
+        )
+    create_index(conn, 'uq_ot_response_active_delegation', 'ot_response', ['schedule_id', 'delegated_to_user_id'],
+                 where=ACTIVE_DELEGATION_WHERE, unique=True)
+
+# (version, name, upgrade(conn)) เรียงตาม version, ห้ามแก้ของที่ปล่อยไปแล้ว ให้เพิ่มอันใหม่แทน
+MIGRATIONS = [
+    (1, 'ot_response_hot_filter_indexes', _migration_ot_response_indexes),
+    (2, 'ot_response_version_and_unique_delegation', _migration_ot_response_concurrency),
+]
+
+def run_migrations():
+    """รัน migration ที่ยังไม่เคยรัน ตามลำดับ -> รายการ version ที่เพิ่งรัน"""
+    applied_now = []
+    with db.engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        is_pg = conn.dialect.name == 'postgresql'
+        if is_pg:
+            conn.execute(text('SELECT pg_advisory_lock(:id)'), {'id': MIGRATION_LOCK_ID})
+        try:
+            applied = {row[0] for row in conn.execute(text('SELECT version FROM schema_version'))}
+            for version, name, upgrade in MIGRATIONS:
+                if version in applied:
+                    continue
+                print(f"Migration {version}: {name}")
+                upgrade(conn)
+                conn.execute(
+                    text('INSERT INTO schema_version (version, name, applied_at) VALUES (:version, :name, :applied_at)'),
+                    {'version': version, 'name': name, 'applied_at': datetime.utcnow()}
+                )
+                applied_now.append(version)
+        finally:
+            if is_pg:
+                conn.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': MIGRATION_LOCK_ID})
+    return applied_now
+
+def initialize_database():
+    """สร้างตารางที่ยังไม่มี + รัน migration ที่ค้าง + สร้าง OTTally ครั้งแรก -> รายการ migration ที่เพิ่งรัน"""
+    db.create_all()
+    applied_now = run_migrations()
+    # ฐานข้อมูลเดิมที่ยังไม่เคยมี OTTally: สร้างให้ครั้งแรกครั้งเดียว
+    if not OTTally.query.first() and OTResponse.query.filter(OTResponse.response_status.in_(CONFIRMED_STATUSES)).first():
+        rebuild_ot_tally()
+    return applied_now
+
+@bp.cli.command('db-upgrade')
+def db_upgrade_command():
+    """สร้างตารางที่ยังไม่มี แล้วรัน migration ที่ค้างอยู่ (รันก่อนเริ่ม server ทุกครั้งที่ deploy)"""
+    applied_now = initialize_database()
+    print(f"Migrate เรียบร้อย ({len(applied_now)} รายการใหม่)")
+
+@bp.cli.command('db-status')
+def db_status_command():
+    """แสดง migration ที่รันแล้ว / ยังไม่ได้รัน"""
+    applied = {row.version: row for row in SchemaVersion.query.all()}
+    for version, name, _ in MIGRATIONS:
+        row = applied.get(version)
+        state = f"applied {row.applied_at:%Y-%m-%d %H:%M}" if row else 'pending'
+        print(f"{version:>4}  {name:<40} {state}")
+
+# --- 2.1 Background worker สำหรับส่ง LINE จาก Outbox ---
+# ส่งข้อความแบบขนานนอก HTTP request; สถานะของแต่ละผู้รับถูกเก็บใน LineOutbox
+LINE_OUTBOX_WORKERS = int(os.environ.get('LINE_OUTBOX_WORKERS', 8))
+LINE_OUTBOX_STALE_SECONDS = int(os.environ.get('LINE_OUTBOX_STALE_SECONDS', 300))
+LINE_OUTBOX_SWEEP_SECONDS = int(os.environ.get('LINE_OUTBOX_SWEEP_SECONDS', 60)) # ตรวจหาแถวที่ค้างทุกๆ กี่วินาที
+line_outbox_executor = ThreadPoolExecutor(max_workers=LINE_OUTBOX_WORKERS, thread_name_prefix='line-outbox')
+
+def line_fanout(method_name, items):
+    """ส่ง [(ผู้รับหรือ reply token, ข้อความ), ...] พร้อมกัน -> [None (สำเร็จ) หรือ exception, ...] ตามลำดับ
+    โหมด sync ใช้ thread pool ของ Outbox; โหมด async ยิงทั้งหมดบน event loop (จำกัดด้วย LINE_ASYNC_CONCURRENCY)"""
+    if LINE_ASYNC_MODE:
+        send = getattr(notification_transport, f'{method_name}_async')
+        results = line_async_runner.gather([send(target, text) for target, text in items])
+        return [result if isinstance(result, BaseException) else None for result in results]
+
+    send = getattr(notification_transport, method_name)
+
+    def _send(item):
+        try:
+            send(*item)
+            return None
+        except Exception as e:
+            return e
+
+    if len(items) <= 1:
+        return [_send(item) for item in items] # ข้อความเดียว: ส่งใน thread นี้เลย
+    return list(line_outbox_executor.map(_send, items))
+
+def enqueue_line_outbox_job(job_id, group_message=None, admin_name=None):
+    """เริ่มส่งข้อความทั้งหมดของ job ใน background แล้ว return ทันที (เรียกใน app context)"""
+    threading.Thread(
+        target=_run_line_outbox_job,
+        args=(current_app._get_current_object(), job_id, group_message, admin_name),
+        name=f'line-outbox-job-{job_id[:8]}',
+        daemon=True
+    ).start()
+
+def _run_line_outbox_job(app, job_id, group_message=None, admin_name=None):
+    with app.app_context():
+        item_ids = [row.id for row in db.session.query(LineOutbox.id).filter_by(job_id=job_id, status='queued').all()]
+
+    if LINE_ASYNC_MODE:
+        line_async_runner.gather([_deliver_line_outbox_item_async(app, item_id) for item_id in item_ids])
+    else:
+        futures = [line_outbox_executor.submit(_deliver_line_outbox_item, app, item_id) for item_id in item_ids]
+        for future in futures:
+            future.result()
+
+    if not group_message:
+        return
+
+    # สรุปผลเข้ากลุ่มหลังส่งครบทุกคนแล้ว (นับจาก DB เพื่อรวมคนที่ไม่มี LINE ID)
+    with app.app_context():
+        counts = dict(db.session.query(LineOutbox.status, func.count(LineOutbox.id))
+                      .filter_by(job_id=job_id).group_by(LineOutbox.status).all())
+        message_to_group = group_message + f"\n\n✅ ระบบได้ส่งลิงก์ Survey ให้พนักงานแล้ว {counts.get('sent', 0)} คน"
+        if counts.get('failed'):
+            message_to_group += f"\n\n🚨 ({admin_name or 'Admin'} โปรดแจกจ่ายลิงก์ที่เหลือเอง)"
+        send_line_push_message(message_to_group)
+
+def _claim_line_outbox_item(app, item_id):
+    """"จอง" แถวนี้ก่อนส่ง กันไม่ให้ worker/process อื่นส่งซ้ำ -> (line_user_id, message_text, recipient_name) หรือ None"""
+    with app.app_context():
+        try:
+            claimed = LineOutbox.query.filter_by(id=item_id, status='queued').update({
+                'status': 'sending',
+                'attempts': LineOutbox.attempts + 1,
+                'updated_at': datetime.utcnow()
+            }, synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                return None
+            item = db.session.get(LineOutbox, item_id)
+            return item.line_user_id, item.message_text, item.recipient_name
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error delivering outbox item {item_id}: {e}")
+            return None
+
+def _finish_line_outbox_item(app, item_id, error):
+    """บันทึกผลการส่ง (error=None คือส่งสำเร็จ) -> True ถ้าส่งสำเร็จ"""
+    with app.app_context():
+        try:
+            item = db.session.get(LineOutbox, item_id)
+            if error is None:
+                item.status = 'sent'
+                item.last_error = None
+            elif isinstance(error, LineSendError):
+                print(f"!!! ส่ง LINE หา {item.recipient_name} ({item.line_user_id}) ไม่สำเร็จ: {error.status_code} {error.message}")
+                item.status = 'failed'
+                item.last_error = str(error.message)[:500]
+            else:
+                print(f"!!! เกิดข้อผิดพลาดอื่นในการส่ง LINE หา {item.recipient_name}: {error}")
+                item.status = 'failed'
+                item.last_error = str(error)[:500]
+            item.updated_at = datetime.utcnow()
+            db.session.commit()
+            return item.status == 'sent'
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error delivering outbox item {item_id}: {e}")
+            return False
+
+def _deliver_line_outbox_item(app, item_id):
+    claimed = _claim_line_outbox_item(app, item_id)
+    if claimed is None:
+        return False
+    line_user_id, message_text, _ = claimed
+    error = None
+    try:
+        notification_transport.push_text(line_user_id, message_text)
+    except Exception as e:
+        error = e
+    return _finish_line_outbox_item(app, item_id, error)
+
+async def _deliver_line_outbox_item_async(app, item_id):
+    # งาน DB (sync) ทำใน thread pool ของ Outbox; ระหว่างรอ LINE ไม่กิน thread
+    loop = asyncio.get_running_loop()
+    claimed = await loop.run_in_executor(line_outbox_executor, _claim_line_outbox_item, app, item_id)
+    if claimed is None:
+        return False
+    line_user_id, message_text, _ = claimed
+    error = None
+    try:
+        await notification_transport.push_text_async(line_user_id, message_text)
+    except Exception as e:
+        error = e
+    return await loop.run_in_executor(line_outbox_executor, _finish_line_outbox_item, app, item_id, error)
+
+def recover_line_outbox(app):
+    """ส่งต่อข้อความที่ค้างเกิน LINE_OUTBOX_STALE_SECONDS (เช่น worker ถูก kill ระหว่างส่ง)
+    แถวถูกจองแบบ atomic (_claim_line_outbox_item) -> หลาย worker sweep พร้อมกันก็ไม่ส่งซ้ำ"""
+    with app.app_context():
+        try:
+            stale_before = datetime.utcnow() - timedelta(seconds=LINE_OUTBOX_STALE_SECONDS)
+            LineOutbox.query.filter(
+                LineOutbox.status == 'sending',
+                LineOutbox.updated_at < stale_before
+            ).update({'status': 'queued'}, synchronize_session=False)
+            db.session.commit()
+            pending_jobs = [row.job_id for row in db.session.query(LineOutbox.job_id).filter(
+                LineOutbox.status == 'queued',
+                LineOutbox.created_at < stale_before
+            ).distinct().all()]
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error recovering LINE outbox: {e}")
+            pending_jobs = []
+        for job_id in pending_jobs:
+            enqueue_line_outbox_job(job_id)
+
+def _sweep_line_outbox(app):
+    # ไม่ใช่แค่ตอนเริ่ม: job ที่ถูกขัดจังหวะไม่ถึง LINE_OUTBOX_STALE_SECONDS ก่อน restart จะถูกเก็บในรอบถัดๆ ไป
+    while True:
+        recover_line_outbox(app)
+        time.sleep(LINE_OUTBOX_SWEEP_SECONDS)
+
+def start_line_outbox_recovery(app):
+    """กู้ Outbox ใน background ตอนเริ่มและทุก LINE_OUTBOX_SWEEP_SECONDS: เรียกเฉพาะ process ที่เสิร์ฟเว็บ
+    (gunicorn post_worker_init / `python app.py`)
+    ห้ามเรียกจาก CLI: process สั้นๆ อาจจองแถว 'sending' แล้วจบไปกลางทาง ทำให้ข้อความค้างจนหมด LINE_OUTBOX_STALE_SECONDS"""
+    threading.Thread(target=_sweep_line_outbox, args=(app,), name='line-outbox-sweeper', daemon=True).start()
+
+
+
+# --- 2.2 (ใหม่) ค้นหาคนว่างที่เป็นตัวแทนได้ (ใช้ร่วมกันทั้งหน้า Survey และ Dashboard) ---
+# cache ต่อ schedule ใน process นี้ และล้างทันทีเมื่อ OTResponse ของ schedule นั้นเปลี่ยน
+# (TTL กันข้อมูลค้างจาก gunicorn worker อื่น; การบันทึกจริงตรวจซ้ำกับ DB เสมอ)
+SUBSTITUTE_CACHE_TTL_SECONDS = int(os.environ.get('SUBSTITUTE_CACHE_TTL_SECONDS', 30))
+_substitute_cache = {} # schedule_id -> (cached_at, [{"id", "name"}], etag ของรายชื่อ)
+_substitute_cache_lock = threading.Lock()
+
+def substitute_candidates_query(schedule_id):
+    is_primary = db.session.query(OTResponse.id).filter(
+        OTResponse.schedule_id == schedule_id,
+        OTResponse.primary_user_id == User.id
+    ).exists()
+    is_active_substitute = db.session.query(OTResponse.id).filter(
+        OTResponse.schedule_id == schedule_id,
+        OTResponse.delegated_to_user_id == User.id,
+        OTResponse.response_status.in_(ACTIVE_DELEGATION_STATUSES)
+    ).exists()
+
+    # anti-join (NOT EXISTS) ใน query เดียว แทน NOT IN (...) ที่ยาวตามขนาดตาราง
+    return db.session.query(User.id, User.full_name).filter(
+        User.is_admin == False,
+        ~is_primary,
+        ~is_active_substitute
+    ).order_by(User.full_name)
+
+def find_substitute_candidates(schedule_id):
+    """พนักงาน (ไม่ใช่ Admin) ที่ไม่ได้เป็นผู้มีสิทธิ์หลัก และไม่ได้เป็นตัวแทนที่ยัง active ใน OT นี้"""
+    return find_substitute_candidates_with_etag(schedule_id)[0]
+
+def find_substitute_candidates_with_etag(schedule_id):
+    """-> (candidates, etag) etag คำนวณจากเนื้อหาครั้งเดียวตอนเติม cache (ทุก worker ได้ค่าเดียวกันถ้ารายชื่อเหมือนกัน)"""
+    now = time.monotonic()
+    with _substitute_cache_lock:
+        cached = _substitute_cache.get(schedule_id)
+    if cached and now - cached[0] < SUBSTITUTE_CACHE_TTL_SECONDS:
+        return cached[1], cached[2]
+
+    rows = substitute_candidates_query(schedule_id).all()
+    candidates = [{"id": row.id, "name": row.full_name} for row in rows]
+    etag = hashlib.sha1(json.dumps(candidates, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    with _substitute_cache_lock:
+        _substitute_cache[schedule_id] = (now, candidates, etag)
+    return candidates, etag
+
+def invalidate_substitute_cache(schedule_ids=None):
+    with _substitute_cache_lock:
+        if schedule_ids is None:
+            _substitute_cache.clear()
+        else:
+            for schedule_id in schedule_ids:
+                _substitute_cache.pop(schedule_id, None)
+
+def _substitute_cache_changes(session):
+    changed = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, OTResponse):
+            changed.add(obj.schedule_id)
+        elif isinstance(obj, User):
+            changed.add(None) # รายชื่อ/สิทธิ์พนักงานเปลี่ยน -> ล้างทั้งหมด
+    return changed
+
+def _apply_substitute_cache_changes(changed):
+    if None in changed:
+        invalidate_substitute_cache()
+    elif changed:
+        invalidate_substitute_cache(changed)
+
+# ล้างตอน flush และซ้ำหลัง commit เผื่อมี request อื่นเติม cache ระหว่าง flush กับ commit
+track_changes_until_commit('substitute_cache_changes', _substitute_cache_changes,
+                           on_commit=_apply_substitute_cache_changes, on_flush=_apply_substitute_cache_changes)
+
+
+# --- 2.3 (ใหม่) ช่วงวันที่ของเดือน / สัปดาห์ ISO ---
+# ทุกช่วงเป็นแบบ half-open [start, end) เพื่อให้กรองด้วย ot_date >= start AND ot_date < end
+# (ใช้ index ของ ot_date ได้ ต่างจากการครอบคอลัมน์ด้วย extract() และใช้ได้ทั้ง SQLite/PostgreSQL)
+def month_bounds(year, month):
+    """[วันที่ 1 ของเดือน, วันที่ 1 ของเดือนถัดไป)"""
+    start = date(year, month, 1)
+    end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return start, end
+
+def iso_week_bounds(iso_year, iso_week):
+    """[วันจันทร์ของสัปดาห์ ISO, วันจันทร์ถัดไป) -- ValueError ถ้าไม่มีสัปดาห์นั้น"""
+    start = date.fromisocalendar(iso_year, iso_week, 1)
+    return start, start + timedelta(days=7)
+
+def ot_date_in_range(start, end):
+    """เงื่อนไขกรอง OTSchedule.ot_date ตามช่วง half-open"""
+    return and_(OTSchedule.ot_date >= start, OTSchedule.ot_date < end)
+
+
+# --- 2.4 (ใหม่) อัปเดตยอด OT (OTTally) ทุกครั้งที่สถานะ response เปลี่ยน ---
+CONFIRMED_STATUSES = ('confirmed', 'sub_confirmed')
+
+def effective_ot_user_id(status, primary_user_id, delegated_to_user_id):
+    """คนที่มาทำ OT จริงตามสถานะ (None = ยังไม่มีใครยืนยัน)"""
+    if status == 'confirmed':
+        return primary_user_id
+    if status == 'sub_confirmed':
+        return delegated_to_user_id
+    return None
+
+# effective_ot_user_id() ในรูป SQL (ใช้คู่กับ filter response_status IN CONFIRMED_STATUSES)
+effective_ot_user_id_column = case(
+    (OTResponse.response_status == 'confirmed', OTResponse.primary_user_id),
+    else_=OTResponse.delegated_to_user_id
+)
+
+def _ot_tally_bucket(ot_date):
+    iso_year, iso_week, _ = ot_date.isocalendar()
+    return dict(year=ot_date.year, month=ot_date.month, iso_year=iso_year, iso_week=iso_week)
+
+def adjust_ot_tally(user_id, ot_date, delta):
+    """เพิ่ม/ลบวันที่ ot_date ของ user_id ใน OTTally (อยู่ใน transaction เดียวกับการเปลี่ยนสถานะ)"""
+    bucket = _ot_tally_bucket(ot_date)
+    tally = OTTally.query.filter_by(user_id=user_id, **bucket).with_for_update().first()
+    if tally is None:
+        if delta < 0:
+            return
+        try:
+            # savepoint: ถ้า request อื่นสร้างแถวเดียวกันไปก่อน ให้กลับไปอัปเดตแถวนั้นแทน
+            with db.session.begin_nested():
+                tally = OTTally(user_id=user_id, count=0, dates='', **bucket)
+                db.session.add(tally)
+        except IntegrityError:
+            tally = OTTally.query.filter_by(user_id=user_id, **bucket).with_for_update().first()
+
+    dates = set(filter(None, tally.dates.split(',')))
+    if delta > 0:
+        dates.add(ot_date.isoformat())
+    else:
+        dates.discard(ot_date.isoformat())
+
+    if dates:
+        tally.dates = ','.join(sorted(dates))
+        tally.count = len(dates)
+    else:
+        db.session.delete(tally)
+
+def record_response_transition(response, old_status, old_delegated_to_user_id, ot_date, new_status=None, changed_by=None):
+    """เรียกทุกครั้งที่สถานะ OTResponse เปลี่ยน (ก่อน commit): บันทึก OTResponseChange และปรับ OTTally
+    new_status=None ใช้ค่าปัจจุบันของ response; ส่ง 'deleted' ตอนลบตาราง
+    changed_by=None ใช้ Admin ที่ Login อยู่; หน้า Survey ส่ง id ของพนักงานที่ตอบ"""
+    new_status = new_status or response.response_status
+    new_delegated = None if new_status == 'deleted' else response.delegated_to_user_id
+    if new_status == old_status and new_delegated == old_delegated_to_user_id:
+        return # ไม่มีอะไรเปลี่ยน: ไม่ลง change feed และไม่ปลุก SSE
+
+    if changed_by is None and has_request_context() and current_user.is_authenticated:
+        changed_by = current_user.id
+    # ยังไม่ INSERT ตอนนี้: รอจนก่อน commit (ดูด้านล่าง)
+    db.session.info.setdefault('pending_response_changes', []).append(OTResponseChange(
+        response_id=response.id,
+        schedule_id=response.schedule_id,
+        ot_date=ot_date,
+        primary_user_id=response.primary_user_id,
+        old_status=old_status,
+        new_status=new_status,
+        old_delegated_to_user_id=old_delegated_to_user_id,
+        new_delegated_to_user_id=new_delegated,
+        changed_by_user_id=changed_by
+    ))
+
+    old_user_id = effective_ot_user_id(old_status, response.primary_user_id, old_delegated_to_user_id)
+    new_user_id = effective_ot_user_id(new_status, response.primary_user_id, new_delegated)
+    if old_user_id == new_user_id:
+        return
+    if old_user_id:
+        adjust_ot_tally(old_user_id, ot_date, -1)
+    if new_user_id:
+        adjust_ot_tally(new_user_id, ot_date, +1)
+
+# id ของ OTResponseChange คือ cursor ของ /api/changes และ SSE: ถ้า INSERT ตั้งแต่ตอนเปลี่ยนสถานะ
+# transaction ที่ติด lock ของ OTTally นานๆ จะ commit แถวที่ id น้อยกว่า cursor ที่ผู้อ่านผ่านไปแล้ว (หายจาก feed)
+# จึง INSERT และประทับเวลาทันทีก่อน commit: ช่วงตั้งแต่ได้ id จนถึง commit สั้นกว่า CHANGES_SETTLE_SECONDS มาก
+@event.listens_for(db.session, 'before_commit')
+def _insert_pending_response_changes(session):
+    if session.in_nested_transaction():
+        return # ปล่อย SAVEPOINT ยังไม่ใช่ commit จริง
+    changes = session.info.pop('pending_response_changes', None)
+    if not changes:
+        return
+    now = datetime.utcnow()
+    for change in changes:
+        change.changed_at = now
+    session.add_all(changes)
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_pending_response_changes(session):
+    if session.in_nested_transaction():
+        return # rollback แค่ SAVEPOINT (เช่น ใน adjust_ot_tally): การเปลี่ยนสถานะยังรอ commit อยู่
+    session.info.pop('pending_response_changes', None)
+
+def rebuild_ot_tally():
+    """คำนวณ OTTally ใหม่ทั้งหมดจาก OTResponse"""
+    OTTally.query.delete()
+    buckets = {}
+    rows = db.session.query(
+        OTResponse.response_status, OTResponse.primary_user_id, OTResponse.delegated_to_user_id, OTSchedule.ot_date
+    ).join(
+        OTSchedule, OTResponse.schedule_id == OTSchedule.id
+    ).filter(
+        OTResponse.response_status.in_(CONFIRMED_STATUSES)
+    ).execution_options(yield_per=1000)
+
+    for status, primary_user_id, delegated_to_user_id, ot_date in rows:
+        user_id = effective_ot_user_id(status, primary_user_id, delegated_to_user_id)
+        if not user_id:
+            continue
+        bucket = _ot_tally_bucket(ot_date)
+        key = (user_id,) + tuple(bucket.values())
+        buckets.setdefault(key, (bucket, set()))[1].add(ot_date.isoformat())
+
+    db.session.add_all([
+        OTTally(user_id=key[0], count=len(dates), dates=','.join(sorted(dates)), **bucket)
+        for key, (bucket, dates) in buckets.items()
+    ])
+    db.session.commit()
+    return len(buckets)
+
+@bp.cli.command('rebuild-ot-tally')
+def rebuild_ot_tally_command():
+    """คำนวณตารางสรุปยอด OT (OTTally) ใหม่ทั้งหมด"""
+    bucket_count = rebuild_ot_tally()
+    print(f"สร้าง OTTally ใหม่เรียบร้อย ({bucket_count} แถว)")
+
+# --- 2.5 (ใหม่) ปลุก SSE stream ของ Dashboard เมื่อมีการเปลี่ยนสถานะ ---
+class ChangeNotifier:
+    """ปลุก stream ใน process เดียวกันทันทีหลัง commit ที่มี OTResponseChange
+    (stream ใน process อื่นจะเห็นเองจากการ poll ทุก SSE_POLL_SECONDS)"""
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.generation = 0
+
+    def notify(self):
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """รอจนกว่าจะมีการเปลี่ยนแปลงหลัง generation ที่ให้มา (หรือหมดเวลา) -> generation ล่าสุด"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+change_notifier = ChangeNotifier()
+
+track_changes_until_commit('response_changes',
+                           lambda session: {obj.id for obj in session.new if isinstance(obj, OTResponseChange)},
+                           on_commit=lambda change_ids: change_notifier.notify())
+
 
 # --- 3. สร้าง API Endpoints ---
 
-@app.route('/')
+@bp.route('/')
 def index():
     if current_user.is_authenticated:
-        return redirect(url_for('admin_dashboard'))
-    return redirect(url_for('login'))
+        return redirect(url_for('main.admin_dashboard'))
+    return redirect(url_for('main.login'))
 
 # --- 3.1 สร้าง Route สำหรับ Login / Logout ---
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('main.admin_dashboard'))
 
     if request.method == 'POST':
         username = request.form['username']
@@ -161,22 +1550,22 @@ def login():
 
         if user and user.is_admin and user.check_password(password):
             login_user(user)
-            return redirect(url_for('admin_dashboard'))
+            return redirect(url_for('main.admin_dashboard'))
         else:
             flash("Username หรือ Password ไม่ถูกต้อง (หรือคุณไม่ใช่ Admin)", "danger")
             return render_template('login.html')
 
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash("ออกจากระบบสำเร็จ", "success")
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 #(สำคัญ!) Route ลับสำหรับ "สร้าง Admin คนแรก" - ควรคอมเมนต์ออกหลังใช้งาน
-# @app.route('/admin/create-first-admin')
+# @bp.route('/admin/create-first-admin')
 # def create_first_admin():
 #     try:
 #         admin_user = User.query.filter_by(username='admin').first()
@@ -202,66 +1591,118 @@ def logout():
 
 
 # --- 3.2 ส่วนของ Survey (User ทั่วไป ไม่ต้อง Login) ---
-@app.route('/survey/<string:token>')
+# (ใหม่) ลิงก์ survey = [response_id, schedule_id] ที่เซ็น HMAC ด้วย SECRET_KEY
+# token ปลอม/เดาสุ่มถูกปฏิเสธก่อนแตะฐานข้อมูล ส่วน token ที่ถูกต้องหาแถวด้วย primary key
+SURVEY_TOKEN_SALT = 'ot-survey'
+LEGACY_SURVEY_TOKEN_LENGTH = 36 # uuid4 ในคอลัมน์ token (ลิงก์ที่ส่งไปก่อนเปลี่ยนมาใช้ signed token)
+
+def _survey_serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt=SURVEY_TOKEN_SALT)
+
+def make_survey_token(response_id, schedule_id):
+    return _survey_serializer().dumps([response_id, schedule_id])
+
+def load_survey_token(token):
+    """-> (response_id, schedule_id) หรือ None ถ้าลายเซ็นไม่ถูกต้อง (ไม่ query ฐานข้อมูล)"""
+    try:
+        response_id, schedule_id = _survey_serializer().loads(token)
+    except (BadSignature, TypeError, ValueError):
+        return None
+    if not isinstance(response_id, int) or not isinstance(schedule_id, int):
+        return None
+    return response_id, schedule_id
+
+def is_legacy_survey_token(token):
+    """token เป็น uuid แบบที่เก็บในคอลัมน์ token หรือไม่ (เช็คก่อน query: ขยะยาว 36 ตัวไม่ต้องแตะฐานข้อมูล)"""
+    if len(token) != LEGACY_SURVEY_TOKEN_LENGTH:
+        return False
+    try:
+        return str(uuid.UUID(token)) == token
+    except ValueError:
+        return False
+
+def survey_url(response_id, schedule_id):
+    # Ensure _external=True for absolute URLs
+    return url_for('main.show_survey', token=make_survey_token(response_id, schedule_id), _external=True)
+
+def get_survey_response(token):
+    """token -> OTResponse (พร้อม primary_user / schedule) หรือ None"""
+    ids = load_survey_token(token)
+    if ids is None:
+        return None
+    response_id, schedule_id = ids
+    response = db.session.get(OTResponse, response_id,
+                              options=[joinedload(OTResponse.primary_user), joinedload(OTResponse.schedule)])
+    if response is None or response.schedule_id != schedule_id:
+        return None
+    return response
+
+@bp.route('/survey/<string:token>')
 def show_survey(token):
-    response = OTResponse.query.filter_by(token=token).first_or_404()
+    response = get_survey_response(token)
+    if response is None:
+        # ลิงก์แบบเก่า (uuid) ที่ส่งไปแล้วยังใช้ได้: พาไปที่ลิงก์แบบใหม่
+        if is_legacy_survey_token(token):
+            legacy = db.session.query(OTResponse.id, OTResponse.schedule_id).filter_by(token=token).first()
+            if legacy:
+                return redirect(url_for('main.show_survey', token=make_survey_token(legacy.id, legacy.schedule_id)), code=301)
+        abort(404)
     # ป้องกันการเข้าถึง survey ที่ตอบไปแล้วโดยตรง (อาจจะเพิ่มเงื่อนไขอื่นๆ เช่น วันที่ผ่านไปแล้ว)
     if response.response_status != 'pending':
          return render_template('survey_closed.html', status=response.response_status) # สร้าง template ใหม่
+    # (ใหม่) ใส่รายชื่อคนแทนมากับหน้าเลย: ใน LINE in-app browser ไม่ต้องรอ fetch อีกรอบก่อนใช้ฟอร์มได้
     return render_template('survey.html',
-                           response_id=response.id,
+                           survey_token=token,
                            user_name=response.primary_user.full_name,
                            ot_date=response.schedule.ot_date,
-                           current_status=response.response_status
+                           current_status=response.response_status,
+                           other_users=find_substitute_candidates(response.schedule_id)
                            )
 
-@app.route('/api/survey-data/<int:response_id>')
-def get_survey_data(response_id):
-    response = OTResponse.query.get_or_404(response_id)
-    current_schedule_id = response.schedule_id
-
-    all_primary_responses = OTResponse.query.filter_by(schedule_id=current_schedule_id).all()
-    all_primary_user_ids = [r.primary_user_id for r in all_primary_responses]
-
-    already_delegated_responses = OTResponse.query.filter(
-        OTResponse.schedule_id == current_schedule_id,
-        OTResponse.delegated_to_user_id.isnot(None),
-        OTResponse.response_status.in_(['delegated', 'sub_confirmed'])
-    ).all()
-    already_delegated_user_ids = [r.delegated_to_user_id for r in already_delegated_responses]
-
-    excluded_user_ids = list(set(all_primary_user_ids + already_delegated_user_ids))
-
-    # (แก้ไข V5) กรอง Admin ออก
-    substitute_users = User.query.filter(
-        User.id.notin_(excluded_user_ids),
-        User.is_admin == False
-    ).order_by(User.full_name).all()
-
-    users_list = [{"id": user.id, "name": user.full_name} for user in substitute_users]
-
-    return jsonify({
-        "response_id": response.id,
+@bp.route('/api/survey-data/<string:token>')
+def get_survey_data(token):
+    response = get_survey_response(token)
+    if response is None:
+        return jsonify({"error": "ลิงก์แบบสำรวจไม่ถูกต้อง"}), 404
+    users_list, candidates_etag = find_substitute_candidates_with_etag(response.schedule_id)
+
+    # (ใหม่) ETag = รายชื่อคนแทน + version ของ response: เปิดซ้ำโดยไม่มีอะไรเปลี่ยนได้ 304 โดยไม่ต้องสร้าง JSON ใหม่
+    etag = hashlib.sha1(
+        f"{candidates_etag}:{response.id}:{response.version}:{response.primary_user.full_name}:{response.schedule.ot_date}".encode('utf-8')
+    ).hexdigest()
+    if etag in request.if_none_match:
+        not_modified = make_response('', 304)
+        not_modified.set_etag(etag)
+        not_modified.headers['Cache-Control'] = 'private, no-cache'
+        return not_modified
+
+    result = jsonify({
         "primary_user_name": response.primary_user.full_name,
         "ot_date": response.schedule.ot_date.strftime('%Y-%m-%d'),
+        "response_status": response.response_status,
         "other_users": users_list
     })
+    result.set_etag(etag)
+    result.headers['Cache-Control'] = 'private, no-cache'
+    return result
 
-@app.route('/submit-ot-response', methods=['POST'])
+@bp.route('/submit-ot-response', methods=['POST'])
 def submit_ot_response():
     data = request.json
     try:
-        response = OTResponse.query.get(data['response_id'])
+        response = get_survey_response(data.get('token'))
         if not response:
             return jsonify({"error": "ไม่พบการตอบรับนี้"}), 404
 
         if response.response_status != 'pending':
-            return jsonify({"error": f"คุณได้ตอบแบบสำรวจนี้ไปแล้ว (สถานะ: {response.response_status})"}), 400
+            return jsonify({"error": f"คุณได้ตอบแบบสำรวจนี้ไปแล้ว (สถานะ: {response.response_status})"}), 409
 
         primary_user_name = response.primary_user.full_name
         ot_date_str = response.schedule.ot_date.strftime('%d/%m/%Y')
+        old_status, old_delegated_id = response.response_status, response.delegated_to_user_id
 
         status = data.get('status')
+        message_to_group = ""
 
         if status == 'confirmed':
             response.response_status = 'confirmed'
@@ -269,8 +1710,6 @@ def submit_ot_response():
             response.let_admin_decide = False
 
         elif status == 'declined':
-            message_to_group = ""
-
             if data.get('let_admin_decide'):
                 response.response_status = 'declined_admin'
                 response.let_admin_decide = True
@@ -289,16 +1728,17 @@ def submit_ot_response():
 
                 current_schedule_id = response.schedule_id
 
+                # ตรวจก่อนเพื่อให้ข้อความชัด; ถ้าชนกันพร้อมกันจริง unique index จะกันไว้ตอน commit
                 existing_delegation = OTResponse.query.filter(
                     OTResponse.schedule_id == current_schedule_id,
                     OTResponse.delegated_to_user_id == delegated_id,
-                    OTResponse.response_status.in_(['delegated', 'sub_confirmed'])
+                    OTResponse.response_status.in_(ACTIVE_DELEGATION_STATUSES)
                 ).first()
 
                 if existing_delegation:
                     substitute_user = User.query.get(delegated_id)
                     sub_name = substitute_user.full_name if substitute_user else "คนนี้"
-                    return jsonify({"error": f"เลือกตัวแทนซ้ำ! ({sub_name} ถูกเลือกไปแล้วโดยคนอื่น)"}), 400
+                    return jsonify({"error": f"เลือกตัวแทนซ้ำ! ({sub_name} ถูกเลือกไปแล้วโดยคนอื่น)"}), 409
 
                 # Check if the delegated user exists
                 substitute_user = User.query.get(delegated_id)
@@ -319,21 +1759,33 @@ def submit_ot_response():
             else:
                  return jsonify({"error": "กรุณาเลือกตัวเลือกในการสละสิทธิ์"}), 400
 
-            if message_to_group:
-                send_line_push_message(message_to_group)
+        else:
+            return jsonify({"error": "สถานะไม่ถูกต้อง (ต้องเป็น confirmed หรือ declined)"}), 400
 
+        record_response_transition(response, old_status, old_delegated_id, response.schedule.ot_date,
+                                   changed_by=response.primary_user_id) # คนที่ตอบ Survey (ไม่ใช่ Admin ที่บังเอิญ Login อยู่)
         db.session.commit()
+
+        # แจ้งกลุ่มหลัง commit เท่านั้น: ถ้าชนกับ request อื่นจะไม่มีข้อความแจ้งผิดๆ ออกไป
+        if message_to_group:
+            send_line_push_message(message_to_group)
         return jsonify({"message": "บันทึกผลสำเร็จ!"}), 200
 
+    except StaleDataError:
+        db.session.rollback()
+        return jsonify({"error": "แบบสำรวจนี้ถูกตอบไปแล้วจากอีกหน้าต่างหนึ่ง กรุณาโหลดหน้าใหม่"}), 409
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "เลือกตัวแทนซ้ำ! (คนนี้เพิ่งถูกเลือกไปโดยคนอื่น)"}), 409
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Error in submit_ot_response: {e}")
+        current_app.logger.error(f"Error in submit_ot_response: {e}")
         return jsonify({"error": str(e)}), 500
 
 
 # --- 3.3 ส่วนของ Admin (ต้อง Login) ---
 
-@app.route('/admin/users')
+@bp.route('/admin/users')
 @login_required
 def admin_users_page():
     if not current_user.is_admin: abort(403)
@@ -344,7 +1796,7 @@ def admin_users_page():
         flash(f"เกิดข้อผิดพลาดในการโหลดข้อมูลผู้ใช้: {str(e)}", "danger")
         return render_template('admin_users.html', users=[])
 
-@app.route('/admin/add-user', methods=['POST'])
+@bp.route('/admin/add-user', methods=['POST'])
 @login_required
 def add_user():
     if not current_user.is_admin: abort(403)
@@ -355,21 +1807,21 @@ def add_user():
 
         if not username or not full_name:
              flash("กรุณากรอก Username และ ชื่อ-สกุล", "warning")
-             return redirect(url_for('admin_users_page'))
+             return redirect(url_for('main.admin_users_page'))
 
         if line_user_id and line_user_id.strip() != "":
             line_user_id = line_user_id.strip() # Remove leading/trailing whitespace
             existing_line_id = User.query.filter_by(line_user_id=line_user_id).first()
             if existing_line_id:
                 flash(f"เกิดข้อผิดพลาด: LINE User ID ({line_user_id}) นี้มีผู้ใช้งานแล้ว", "danger")
-                return redirect(url_for('admin_users_page'))
+                return redirect(url_for('main.admin_users_page'))
         else:
             line_user_id = None
 
         existing_user = User.query.filter_by(username=username).first()
         if existing_user:
             flash("เกิดข้อผิดพลาด: Username นี้มีผู้ใช้งานแล้ว", "danger")
-            return redirect(url_for('admin_users_page'))
+            return redirect(url_for('main.admin_users_page'))
 
         new_user = User(
             username=username,
@@ -383,9 +1835,9 @@ def add_user():
     except Exception as e:
         db.session.rollback()
         flash(f"เกิดข้อผิดพลาดในการเพิ่มผู้ใช้: {str(e)}", "danger")
-    return redirect(url_for('admin_users_page'))
+    return redirect(url_for('main.admin_users_page'))
 
-@app.route('/admin/delete-user/<int:user_id>', methods=['POST'])
+@bp.route('/admin/delete-user/<int:user_id>', methods=['POST'])
 @login_required
 def delete_user(user_id):
     if not current_user.is_admin: abort(403)
@@ -394,7 +1846,7 @@ def delete_user(user_id):
 
         if user.is_admin:
             flash("ไม่สามารถลบผู้ดูแลระบบได้", "danger")
-            return redirect(url_for('admin_users_page'))
+            return redirect(url_for('main.admin_users_page'))
 
         # Check dependencies more carefully
         has_primary_responses = OTResponse.query.filter_by(primary_user_id=user_id).first()
@@ -402,7 +1854,7 @@ def delete_user(user_id):
 
         if has_primary_responses or has_delegated_responses:
             flash("ไม่สามารถลบผู้ใช้นี้ได้: ผู้ใช้มีข้อมูลผูกพันอยู่ในตาราง OT ที่สร้างไปแล้ว (เป็นผู้มีสิทธิ์หลัก หรือ ผู้รับมอบสิทธิ์)", "danger")
-            return redirect(url_for('admin_users_page'))
+            return redirect(url_for('main.admin_users_page'))
 
         db.session.delete(user)
         db.session.commit()
@@ -410,9 +1862,9 @@ def delete_user(user_id):
     except Exception as e:
         db.session.rollback()
         flash(f"เกิดข้อผิดพลาดในการลบผู้ใช้: {str(e)}", "danger")
-    return redirect(url_for('admin_users_page'))
+    return redirect(url_for('main.admin_users_page'))
 
-@app.route('/admin/edit-user/<int:user_id>', methods=['POST'])
+@bp.route('/admin/edit-user/<int:user_id>', methods=['POST'])
 @login_required
 def edit_user(user_id):
     if not current_user.is_admin: abort(403)
@@ -444,10 +1896,10 @@ def edit_user(user_id):
         return jsonify({"message": "success", "new_name": user.full_name, "new_line_id": user.line_user_id}), 200
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Error editing user {user_id}: {e}")
+        current_app.logger.error(f"Error editing user {user_id}: {e}")
         return jsonify({"error": f"เกิดข้อผิดพลาดในการแก้ไข: {str(e)}"}), 500
 
-@app.route('/admin/delete-schedule/<int:schedule_id>', methods=['POST'])
+@bp.route('/admin/delete-schedule/<int:schedule_id>', methods=['POST'])
 @login_required
 def delete_schedule(schedule_id):
     if not current_user.is_admin: abort(403)
@@ -455,23 +1907,132 @@ def delete_schedule(schedule_id):
         schedule = OTSchedule.query.get_or_404(schedule_id)
         # Cascade should handle deleting responses, but explicitly doing it might be safer
         # OTResponse.query.filter_by(schedule_id=schedule_id).delete()
+        for response in schedule.responses:
+            record_response_transition(
+                response, response.response_status, response.delegated_to_user_id, schedule.ot_date, new_status='deleted'
+            )
         db.session.delete(schedule)
         db.session.commit()
         flash(f"ลบตาราง OT วันที่ {schedule.ot_date.strftime('%d/%m/%Y')} สำเร็จ", "success")
     except Exception as e:
         db.session.rollback()
         flash(f"เกิดข้อผิดพลาดในการลบตาราง: {str(e)}", "danger")
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('main.admin_dashboard'))
 
 
-@app.route('/admin/create')
+@bp.route('/admin/create')
 @login_required
 def admin_create_page():
     if not current_user.is_admin: abort(403)
     all_users = User.query.filter_by(is_admin=False).order_by(User.full_name).all()
     return render_template('create_schedule.html', users=all_users)
 
-@app.route('/api/create-schedule', methods=['POST'])
+# (ใหม่) สร้างตาราง OT หลายวันพร้อมกัน: INSERT แบบ bulk ทั้ง schedule / response / outbox ใน transaction เดียว
+BULK_SCHEDULE_MAX_DATES = 366
+
+def _load_schedule_users(primary_user_ids_str):
+    """แปลง/ตรวจรายชื่อพนักงาน -> (users เรียงตามที่ส่งมา, error)"""
+    try:
+        primary_user_ids = list(dict.fromkeys(int(uid) for uid in primary_user_ids_str))
+    except (ValueError, TypeError):
+        return None, "ข้อมูล User ID ไม่ถูกต้อง"
+    selected_users = User.query.filter(User.id.in_(primary_user_ids), User.is_admin == False).all()
+    if len(selected_users) != len(primary_user_ids):
+        invalid_ids = set(primary_user_ids) - set(u.id for u in selected_users)
+        return None, f"ไม่พบข้อมูลพนักงานบางคน หรือเลือก Admin (IDs: {invalid_ids})"
+    user_map = {u.id: u for u in selected_users}
+    return [user_map[user_id] for user_id in primary_user_ids], None
+
+def expand_recurrence(rule):
+    """{"start", "end", "weekdays": [1-7 (จันทร์=1)], "interval_weeks"} -> รายการวันที่"""
+    start = datetime.strptime(rule['start'], '%Y-%m-%d').date()
+    end = datetime.strptime(rule['end'], '%Y-%m-%d').date()
+    weekdays = {int(day) for day in rule.get('weekdays') or [start.isoweekday()]}
+    interval_weeks = max(int(rule.get('interval_weeks', 1)), 1)
+    if not weekdays <= set(range(1, 8)):
+        raise ValueError("weekdays ต้องเป็น 1 (จันทร์) ถึง 7 (อาทิตย์)")
+    if end < start or (end - start).days > BULK_SCHEDULE_MAX_DATES * 7:
+        raise ValueError("ช่วงวันที่ของ recurrence ไม่ถูกต้อง")
+
+    first_monday = start - timedelta(days=start.weekday())
+    dates = []
+    day = start
+    while day <= end:
+        if day.isoweekday() in weekdays and ((day - first_monday).days // 7) % interval_weeks == 0:
+            dates.append(day)
+        day += timedelta(days=1)
+    return dates
+
+def _insert_returning(model, params, returning, fallback_query):
+    """INSERT หลายแถวแล้วคืนค่าคอลัมน์ที่ต้องใช้ (RETURNING ถ้า dialect รองรับ ไม่งั้น SELECT กลับครั้งเดียว)"""
+    if db.engine.dialect.insert_executemany_returning:
+        return db.session.execute(insert(model).returning(*returning), params).all()
+    db.session.execute(insert(model), params)
+    return fallback_query.all()
+
+def create_schedules_with_outbox(ot_dates, users):
+    """INSERT OTSchedule ทุกวัน + OTResponse ทุกคน + LineOutbox ทุกข้อความ (ยังไม่ commit)
+    -> (job_id, [(schedule_id, ot_date)])"""
+    now = datetime.utcnow()
+    schedule_rows = _insert_returning(
+        OTSchedule, [{'ot_date': ot_date, 'created_at': now} for ot_date in ot_dates],
+        (OTSchedule.id, OTSchedule.ot_date),
+        db.session.query(OTSchedule.id, OTSchedule.ot_date).filter(OTSchedule.ot_date.in_(ot_dates))
+    )
+    schedule_rows = sorted(schedule_rows, key=lambda row: row[1])
+    schedule_ids = [schedule_id for schedule_id, _ in schedule_rows]
+
+    # ลิงก์ survey ต้องใช้ id ของ response (signed token) จึงต้องได้ id กลับมาก่อนสร้าง outbox
+    response_rows = _insert_returning(
+        OTResponse,
+        [{'token': str(uuid.uuid4()), 'schedule_id': schedule_id, 'primary_user_id': user.id,
+          'response_status': 'pending', 'let_admin_decide': False}
+         for schedule_id in schedule_ids for user in users],
+        (OTResponse.id, OTResponse.schedule_id, OTResponse.primary_user_id),
+        db.session.query(OTResponse.id, OTResponse.schedule_id, OTResponse.primary_user_id)
+            .filter(OTResponse.schedule_id.in_(schedule_ids))
+    )
+    response_ids = {(schedule_id, user_id): response_id for response_id, schedule_id, user_id in response_rows}
+
+    job_id = str(uuid.uuid4())
+    outbox_params = []
+    for schedule_id, ot_date in schedule_rows:
+        for user in users:
+            survey_link = survey_url(response_ids[(schedule_id, user.id)], schedule_id)
+            outbox_params.append({
+                'job_id': job_id,
+                'schedule_id': schedule_id,
+                'user_id': user.id,
+                'recipient_name': user.full_name,
+                'line_user_id': user.line_user_id,
+                'message_text': (
+                    f"สวัสดีครับ คุณ {user.full_name},\n\n"
+                    f"คุณได้รับสิทธิ์ OT สำหรับวันที่ {ot_date.strftime('%d/%m/%Y')}\n"
+                    f"กรุณากดยืนยัน/สละสิทธิ์ ภายในลิงก์นี้:\n\n"
+                    f"{survey_link}"
+                ),
+                'survey_link': survey_link,
+                # ไม่มี LINE ID = ส่งไม่ได้ตั้งแต่แรก ให้ Admin แจกลิงก์เอง
+                'status': 'queued' if user.line_user_id else 'failed',
+                'attempts': 0,
+                'last_error': None if user.line_user_id else "ไม่มี LINE ID",
+                'created_at': now,
+                'updated_at': now
+            })
+    db.session.execute(insert(LineOutbox), outbox_params)
+    invalidate_substitute_cache(schedule_ids) # bulk insert ไม่ผ่าน session events
+    return job_id, schedule_rows
+
+def _new_schedule_group_message(ot_dates, users):
+    names_list_str = "\n".join(f"- {user.full_name}" for user in users)
+    dates_str = ", ".join(ot_date.strftime('%d/%m/%Y') for ot_date in ot_dates)
+    return (
+        f"📢 สร้างตาราง OT ใหม่ 📢\n"
+        f"วันที่: {dates_str}\n\n"
+        f"ผู้มีสิทธิ์หลัก:\n{names_list_str}"
+    )
+
+@bp.route('/api/create-schedule', methods=['POST'])
 @login_required
 def create_schedule():
     if not current_user.is_admin: abort(403)
@@ -482,13 +2043,6 @@ def create_schedule():
     if not ot_date_str or not primary_user_ids_str:
         return jsonify({"error": "กรุณาเลือกวันที่และพนักงานอย่างน้อย 1 คน"}), 400
 
-    try:
-        # Convert user IDs to integers
-        primary_user_ids = [int(uid) for uid in primary_user_ids_str]
-    except ValueError:
-         return jsonify({"error": "ข้อมูล User ID ไม่ถูกต้อง"}), 400
-
-
     try:
         ot_date = datetime.strptime(ot_date_str, '%Y-%m-%d').date()
 
@@ -500,100 +2054,163 @@ def create_schedule():
         if existing_schedule:
             return jsonify({"error": f"มีตาราง OT สำหรับวันที่ {ot_date_str} อยู่แล้ว"}), 400
 
-        new_schedule = OTSchedule(ot_date=ot_date)
-        db.session.add(new_schedule)
-        db.session.commit() # Commit schedule first to get its ID
-
         # Verify selected users exist and are not admins
-        selected_users = User.query.filter(User.id.in_(primary_user_ids), User.is_admin == False).all()
-        if len(selected_users) != len(primary_user_ids):
-             db.session.rollback() # Rollback schedule creation if users are invalid
-             invalid_ids = set(primary_user_ids) - set(u.id for u in selected_users)
-             return jsonify({"error": f"ไม่พบข้อมูลพนักงานบางคน หรือเลือก Admin (IDs: {invalid_ids})"}), 400
-
-        user_map = {u.id: u for u in selected_users}
-
-        for user_id in primary_user_ids:
-            response = OTResponse(schedule_id=new_schedule.id, primary_user_id=user_id)
-            db.session.add(response)
-        db.session.commit() # Commit responses
-
-        # Now fetch the committed responses to get tokens
-        created_responses = OTResponse.query.filter_by(schedule_id=new_schedule.id).all()
-
-        links_for_admin_fallback = []
-        names_list_for_group = []
-        users_sent_count = 0
+        users, error = _load_schedule_users(primary_user_ids_str)
+        if error:
+            return jsonify({"error": error}), 400
 
-        # Use app context for url_for outside of request context (important for sending links)
-        with app.app_context():
-            for resp in created_responses:
-                user = user_map.get(resp.primary_user_id)
-                if not user:
-                    continue
-
-                names_list_for_group.append(f"- {user.full_name}")
-                # Ensure _external=True for absolute URLs
-                survey_link = url_for('show_survey', token=resp.token, _external=True)
-
-                if user.line_user_id:
-                    try:
-                        message_text = (
-                            f"สวัสดีครับ คุณ {user.full_name},\n\n"
-                            f"คุณได้รับสิทธิ์ OT สำหรับวันที่ {ot_date.strftime('%d/%m/%Y')}\n"
-                            f"กรุณากดยืนยัน/สละสิทธิ์ ภายในลิงก์นี้:\n\n"
-                            f"{survey_link}"
-                        )
-                        message = TextSendMessage(text=message_text)
-                        line_bot_api.push_message(user.line_user_id, messages=message)
-                        users_sent_count += 1
-                    except LineBotApiError as line_error:
-                         print(f"!!! ส่ง LINE หา {user.full_name} ({user.line_user_id}) ไม่สำเร็จ: {line_error.status_code} {line_error.error.message}")
-                         links_for_admin_fallback.append({
-                            "name": f"{user.full_name} (ส่ง LINE ไม่สำเร็จ: {line_error.error.message})",
-                            "link": survey_link
-                        })
-                    except Exception as e:
-                        print(f"!!! เกิดข้อผิดพลาดอื่นในการส่ง LINE หา {user.full_name}: {e}")
-                        links_for_admin_fallback.append({
-                            "name": f"{user.full_name} (ส่ง LINE ไม่สำเร็จ)",
-                            "link": survey_link
-                        })
-                else:
-                    links_for_admin_fallback.append({
-                        "name": f"{user.full_name} (ไม่มี LINE ID)",
-                        "link": survey_link
-                    })
-
-        names_list_str = "\n".join(names_list_for_group)
-        message_to_group = (
-            f"📢 สร้างตาราง OT ใหม่ 📢\n"
-            f"วันที่: {ot_date.strftime('%d/%m/%Y')}\n\n"
-            f"ผู้มีสิทธิ์หลัก:\n{names_list_str}\n\n"
-            f"✅ ระบบได้ส่งลิงก์ Survey ให้พนักงานแล้ว {users_sent_count} คน"
-        )
-        if links_for_admin_fallback:
-            message_to_group += f"\n\n🚨 ({current_user.full_name} โปรดแจกจ่ายลิงก์ที่เหลือเอง)"
+        # schedule + responses + outbox commit พร้อมกันครั้งเดียว แล้วให้ worker ส่ง LINE ทีหลัง
+        job_id, schedule_rows = create_schedules_with_outbox([ot_date], users)
+        db.session.commit()
 
-        send_line_push_message(message_to_group)
-        # Use flash for success message on redirect, not needed for API response
-        # flash(f"สร้างตาราง OT วันที่ {ot_date_str} และส่งข้อความ LINE สำเร็จ!", "success")
+        enqueue_line_outbox_job(job_id, group_message=_new_schedule_group_message([ot_date], users),
+                                admin_name=current_user.full_name)
 
         return jsonify({
-            "message": f"สร้างตาราง OT วันที่ {ot_date_str} สำเร็จ! ส่ง LINE ให้พนักงาน {users_sent_count} คน",
-            "links": links_for_admin_fallback,
-            "schedule_id": new_schedule.id
+            "message": f"สร้างตาราง OT วันที่ {ot_date_str} สำเร็จ! กำลังส่ง LINE ให้พนักงาน {len(users)} คน",
+            "job_id": job_id,
+            "status_url": url_for('main.line_job_status', job_id=job_id),
+            "schedule_id": schedule_rows[0][0]
         }), 201
 
     except ValueError:
          return jsonify({"error": "รูปแบบวันที่ในข้อมูลไม่ถูกต้อง"}), 400
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": f"มีตาราง OT สำหรับวันที่ {ot_date_str} อยู่แล้ว"}), 400
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error creating schedule: {e}")
+        return jsonify({"error": f"เกิดข้อผิดพลาดในการสร้างตาราง: {str(e)}"}), 500
+
+@bp.route('/api/create-schedules', methods=['POST'])
+@login_required
+def create_schedules():
+    """สร้างหลายวันในครั้งเดียว: {"user_ids", "dates": [...]} หรือ {"user_ids", "recurrence": {...}}
+    วันที่มีตารางอยู่แล้ว -> 409 พร้อมรายการ (หรือข้ามไปถ้าส่ง "skip_existing": true)"""
+    if not current_user.is_admin: abort(403)
+    data = request.json or {}
+    if not data.get('user_ids') or not (data.get('dates') or data.get('recurrence')):
+        return jsonify({"error": "กรุณาระบุ user_ids และ dates หรือ recurrence"}), 400
+
+    try:
+        if data.get('dates'):
+            ot_dates = [datetime.strptime(value, '%Y-%m-%d').date() for value in data['dates']]
+        else:
+            ot_dates = expand_recurrence(data['recurrence'])
+    except (KeyError, TypeError):
+        return jsonify({"error": "recurrence ต้องมี start และ end (YYYY-MM-DD)"}), 400
+    except ValueError as e:
+        return jsonify({"error": f"วันที่ไม่ถูกต้อง: {e}"}), 400
+
+    ot_dates = sorted(set(ot_dates))
+    past_dates = [d.strftime('%Y-%m-%d') for d in ot_dates if d < date.today()]
+    ot_dates = [d for d in ot_dates if d >= date.today()]
+    if not ot_dates:
+        return jsonify({"error": "ไม่มีวันที่ที่สร้างได้ (วันที่ผ่านมาแล้วทั้งหมด)", "past_dates": past_dates}), 400
+    if len(ot_dates) > BULK_SCHEDULE_MAX_DATES:
+        return jsonify({"error": f"สร้างได้ครั้งละไม่เกิน {BULK_SCHEDULE_MAX_DATES} วัน"}), 400
+
+    users, error = _load_schedule_users(data['user_ids'])
+    if error:
+        return jsonify({"error": error}), 400
+
+    # ตรวจวันที่ซ้ำทั้งหมดด้วย query เดียว แล้วรายงานกลับพร้อมกัน
+    conflicts = [
+        {"date": ot_date.strftime('%Y-%m-%d'), "schedule_id": schedule_id}
+        for schedule_id, ot_date in db.session.query(OTSchedule.id, OTSchedule.ot_date)
+            .filter(OTSchedule.ot_date.in_(ot_dates)).order_by(OTSchedule.ot_date).all()
+    ]
+    if conflicts and not data.get('skip_existing'):
+        return jsonify({"error": f"มีตาราง OT อยู่แล้ว {len(conflicts)} วัน", "conflicts": conflicts, "past_dates": past_dates}), 409
+    conflict_dates = {conflict['date'] for conflict in conflicts}
+    ot_dates = [d for d in ot_dates if d.strftime('%Y-%m-%d') not in conflict_dates]
+    if not ot_dates:
+        return jsonify({"error": "ทุกวันที่เลือกมีตาราง OT อยู่แล้ว", "conflicts": conflicts, "past_dates": past_dates}), 409
+
+    try:
+        job_id, schedule_rows = create_schedules_with_outbox(ot_dates, users)
+        db.session.commit()
+    except IntegrityError:
+        # มีคนสร้างวันเดียวกันแทรกเข้ามาระหว่างตรวจกับ INSERT: ไม่สร้างอะไรเลย ให้ส่งมาใหม่
+        db.session.rollback()
+        return jsonify({"error": "มีการสร้างตาราง OT วันเดียวกันพร้อมกัน กรุณาลองใหม่"}), 409
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Error creating schedule: {e}")
+        current_app.logger.error(f"Error creating schedules: {e}")
         return jsonify({"error": f"เกิดข้อผิดพลาดในการสร้างตาราง: {str(e)}"}), 500
 
+    enqueue_line_outbox_job(job_id, group_message=_new_schedule_group_message(ot_dates, users),
+                            admin_name=current_user.full_name)
+
+    return jsonify({
+        "message": f"สร้างตาราง OT {len(schedule_rows)} วันสำเร็จ! กำลังส่ง LINE ให้พนักงาน {len(users)} คน",
+        "job_id": job_id,
+        "status_url": url_for('main.line_job_status', job_id=job_id),
+        "schedules": [{"schedule_id": schedule_id, "date": ot_date.strftime('%Y-%m-%d')} for schedule_id, ot_date in schedule_rows],
+        "conflicts": conflicts,
+        "past_dates": past_dates
+    }), 201
+
+# (ใหม่) สถานะการส่ง LINE ราย "ผู้รับ" ของแต่ละ job (แทน links_for_admin_fallback เดิม)
+@bp.route('/api/line-jobs/<string:job_id>')
+@login_required
+def line_job_status(job_id):
+    if not current_user.is_admin: abort(403)
+    items = LineOutbox.query.filter_by(job_id=job_id).order_by(LineOutbox.id).all()
+    if not items:
+        return jsonify({"error": "ไม่พบงานส่ง LINE นี้"}), 404
+
+    counts = {'queued': 0, 'sent': 0, 'failed': 0}
+    recipients = []
+    for item in items:
+        status = 'queued' if item.status == 'sending' else item.status
+        counts[status] = counts.get(status, 0) + 1
+        recipients.append({
+            "user_id": item.user_id,
+            "name": item.recipient_name,
+            "status": status,
+            "error": item.last_error,
+            "attempts": item.attempts,
+            "link": item.survey_link
+        })
+
+    return jsonify({
+        "job_id": job_id,
+        "schedule_id": items[0].schedule_id,
+        "done": counts['queued'] == 0,
+        "counts": counts,
+        "recipients": recipients
+    })
+
+# (ใหม่) ตัวนับของ LINE transport (throttle / retry / circuit breaker)
+@bp.route('/api/line-stats')
+@login_required
+def line_stats():
+    if not current_user.is_admin: abort(403)
+    data = notification_transport.stats()
+    data['async_mode'] = LINE_ASYNC_MODE
+    return jsonify(data)
+
+# (ใหม่) ความลึกของ queue และเวลาประมวลผล webhook
+@bp.route('/api/webhook-stats')
+@login_required
+def webhook_queue_stats():
+    if not current_user.is_admin: abort(403)
+    with webhook_stats_lock:
+        data = dict(webhook_stats)
+    finished = data['processed'] + data['failed']
+    data['wait_ms_avg'] = data['wait_ms_total'] / finished if finished else 0.0
+    data['process_ms_avg'] = data['process_ms_total'] / finished if finished else 0.0
+    for key in ('wait_ms_total', 'wait_ms_max', 'wait_ms_avg', 'process_ms_total', 'process_ms_max', 'process_ms_avg'):
+        data[key] = round(data[key], 2)
+    data['queue_depth'] = webhook_queue.qsize()
+    data['workers'] = len(webhook_workers)
+    data['async_mode'] = LINE_WEBHOOK_ASYNC
+    return jsonify(data)
+
 # ฟังก์ชันสำหรับเตือน LINE
-@app.route('/api/send-line-reminder', methods=['POST'])
+@bp.route('/api/send-line-reminder', methods=['POST'])
 @login_required
 def send_line_reminder():
     if not current_user.is_admin: abort(403)
@@ -613,22 +2230,119 @@ def send_line_reminder():
             f"กรุณากดลิงก์นี้เพื่อยืนยัน/สละสิทธิ์:\n\n"
             f"{survey_link}"
         )
-        message = TextSendMessage(text=message_text)
-        line_bot_api.push_message(line_user_id, messages=message)
+        notification_transport.push_text(line_user_id, message_text)
         return jsonify({"message": "ส่ง LINE เตือนสำเร็จ!"}), 200
-    except LineBotApiError as e:
+    except LineSendError as e:
         print(f"Error sending LINE reminder to {full_name} ({line_user_id}): {e.message}")
-        # Provide more specific error if possible
-        error_detail = e.error.message if hasattr(e, 'error') and hasattr(e.error, 'message') else str(e)
-        return jsonify({"error": f"ส่ง LINE ไม่สำเร็จ: {error_detail}"}), 500
+        status_code = 503 if isinstance(e, LineCircuitOpenError) else 500
+        return jsonify({"error": f"ส่ง LINE ไม่สำเร็จ: {e.message}"}), status_code
     except Exception as e:
         print(f"Unexpected error sending LINE reminder: {e}")
-        app.logger.error(f"Unexpected error sending LINE reminder to {line_user_id}: {e}")
+        current_app.logger.error(f"Unexpected error sending LINE reminder to {line_user_id}: {e}")
         return jsonify({"error": f"เกิดข้อผิดพลาดที่ไม่คาดคิด: {str(e)}"}), 500
 
 
+# (ใหม่) เตือน LINE ทุกคนที่ยังค้างตอบในตาราง OT นี้ (กดครั้งเดียว)
+@bp.route('/api/schedules/<int:schedule_id>/remind-pending', methods=['POST'])
+@login_required
+def remind_pending(schedule_id):
+    if not current_user.is_admin: abort(403)
+
+    # ดึง response + ผู้มีสิทธิ์หลัก + ตัวแทน ใน query เดียว
+    rows = db.session.query(
+        OTResponse.id, OTResponse.schedule_id, OTResponse.response_status, OTSchedule.ot_date,
+        User.full_name.label('primary_name'), User.line_user_id.label('primary_line_id'),
+        User_sub.full_name.label('sub_name'), User_sub.line_user_id.label('sub_line_id')
+    ).join(
+        OTSchedule, OTResponse.schedule_id == OTSchedule.id
+    ).join(
+        User, OTResponse.primary_user_id == User.id
+    ).outerjoin(
+        User_sub, OTResponse.delegated_to_user_id == User_sub.id
+    ).filter(
+        OTResponse.schedule_id == schedule_id,
+        OTResponse.response_status.in_(['pending', 'delegated'])
+    ).order_by(OTResponse.id).all()
+
+    if not rows and not db.session.get(OTSchedule, schedule_id):
+        abort(404)
+
+    reminders = []
+    skipped = []
+    for row in rows:
+        ot_date_str = row.ot_date.strftime('%d/%m/%Y')
+        if row.response_status == 'pending':
+            name, line_user_id = row.primary_name, row.primary_line_id
+            survey_link = survey_url(row.id, row.schedule_id)
+            message_text = (
+                f"สวัสดีครับ คุณ {name},\n\n"
+                f"Admin แจ้งเตือนเรื่อง OT สำหรับวันที่ {ot_date_str} ที่คุณยังไม่ได้ตอบกลับครับ\n"
+                f"กรุณากดลิงก์นี้เพื่อยืนยัน/สละสิทธิ์:\n\n"
+                f"{survey_link}"
+            )
+        else:
+            # delegated: ตัวแทนยังไม่ได้ยืนยันกับ Admin
+            name, line_user_id = row.sub_name or f"ตัวแทนของ {row.primary_name}", row.sub_line_id
+            message_text = (
+                f"สวัสดีครับ คุณ {name},\n\n"
+                f"คุณได้รับมอบสิทธิ์ OT วันที่ {ot_date_str} จากคุณ {row.primary_name}\n"
+                f"กรุณาติดต่อ Admin เพื่อยืนยันว่าจะมาทำ OT แทนครับ"
+            )
+
+        if not line_user_id:
+            skipped.append({"response_id": row.id, "name": name, "error": "ไม่มี LINE ID"})
+            continue
+        reminders.append((row.id, name, line_user_id, message_text))
+
+    # ส่งแบบขนาน (worker pool เดียวกับ Outbox หรือ event loop ในโหมด async)
+    results = line_fanout('push_text', [(line_user_id, message_text) for _, _, line_user_id, message_text in reminders])
+    sent_count = 0
+    failures = []
+    for (response_id, name, _, _), error in zip(reminders, results):
+        if error is None:
+            sent_count += 1
+        elif isinstance(error, LineSendError):
+            failures.append({"response_id": response_id, "name": name, "error": error.message})
+        else:
+            current_app.logger.error(f"Unexpected error sending LINE reminder for response {response_id}: {error}")
+            failures.append({"response_id": response_id, "name": name, "error": str(error)})
+
+    return jsonify({
+        "message": f"ส่ง LINE เตือนสำเร็จ {sent_count} จาก {len(rows)} คน",
+        "schedule_id": schedule_id,
+        "total": len(rows),
+        "sent": sent_count,
+        "failed": failures + skipped
+    }), 200
+
+# (ใหม่) ปุ่มใน Dashboard ส่งมาแบบ Accept: application/json -> ตอบแถวที่เปลี่ยนกลับไปแทนการ redirect ทั้งหน้า
+def _wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
+def response_row_payload(response):
+    """แถวใน Dashboard (HTML) + สรุปยอด + รายชื่อคนว่าง หลังจาก response เปลี่ยน"""
+    substitutes = find_substitute_candidates(response.schedule_id)
+    return {
+        "response_id": response.id,
+        "row_html": render_template('_response_row.html', r=response, row_number='',
+                                    selected_schedule=response.schedule, available_substitutes=substitutes),
+        "summary": get_schedule_summary(response.schedule_id),
+        "substitutes": substitutes
+    }
+
+# (ใหม่) UPDATE ชนกับอีก request (version ไม่ตรง) -> 409
+STALE_RESPONSE_MESSAGE = "รายการนี้เพิ่งถูกแก้ไขโดยคนอื่น กรุณาโหลดหน้าใหม่แล้วลองอีกครั้ง"
+
+def _action_reply(schedule_id, message, category, status_code=200, response=None):
+    if _wants_json():
+        if status_code >= 400:
+            return jsonify({"error": message}), status_code
+        return jsonify(dict(message=message, **response_row_payload(response))), status_code
+    flash(message, category)
+    return redirect(url_for('main.admin_dashboard', schedule_id=schedule_id))
+
 # ฟังก์ชันยืนยันตัวแทน
-@app.route('/admin/substitute/confirm/<int:response_id>', methods=['POST'])
+@bp.route('/admin/substitute/confirm/<int:response_id>', methods=['POST'])
 @login_required
 def confirm_substitute(response_id):
     if not current_user.is_admin: abort(403)
@@ -636,11 +2350,12 @@ def confirm_substitute(response_id):
     schedule_id_redirect = response.schedule_id # Get schedule ID before potential commit error
 
     if not response.delegated_user or response.response_status not in ['delegated', 'sub_declined']:
-        flash("ไม่สามารถยืนยันตัวแทนได้ (สถานะไม่ถูกต้อง หรือ ไม่มีผู้รับมอบสิทธิ์)", "danger")
-        return redirect(url_for('admin_dashboard', schedule_id=schedule_id_redirect))
+        return _action_reply(schedule_id_redirect, "ไม่สามารถยืนยันตัวแทนได้ (สถานะไม่ถูกต้อง หรือ ไม่มีผู้รับมอบสิทธิ์)", "danger", 409)
 
     try:
+        old_status = response.response_status
         response.response_status = 'sub_confirmed'
+        record_response_transition(response, old_status, response.delegated_to_user_id, response.schedule.ot_date)
         db.session.commit()
 
         ot_date_str = response.schedule.ot_date.strftime('%d/%m/%Y')
@@ -650,18 +2365,22 @@ def confirm_substitute(response_id):
             f"ตัวแทน: คุณ {response.delegated_user.full_name} (ยืนยันมาแน่นอน)"
         )
         send_line_push_message(message_to_group)
-        flash("ยืนยันตัวแทนเรียบร้อยแล้ว", "success")
+        return _action_reply(schedule_id_redirect, "ยืนยันตัวแทนเรียบร้อยแล้ว", "success", response=response)
 
+    except StaleDataError:
+         db.session.rollback()
+         return _action_reply(schedule_id_redirect, STALE_RESPONSE_MESSAGE, "warning", 409)
+    except IntegrityError:
+         db.session.rollback()
+         return _action_reply(schedule_id_redirect, "ยืนยันไม่ได้: ตัวแทนคนนี้ถูกเลือกให้คนอื่นในวันเดียวกันไปแล้ว", "danger", 409)
     except Exception as e:
          db.session.rollback()
-         flash(f"เกิดข้อผิดพลาดในการยืนยันตัวแทน: {e}", "danger")
-         app.logger.error(f"Error confirming substitute for response {response_id}: {e}")
-
-    return redirect(url_for('admin_dashboard', schedule_id=schedule_id_redirect))
+         current_app.logger.error(f"Error confirming substitute for response {response_id}: {e}")
+         return _action_reply(schedule_id_redirect, f"เกิดข้อผิดพลาดในการยืนยันตัวแทน: {e}", "danger", 500)
 
 
 # ฟังก์ชันปฏิเสธตัวแทน
-@app.route('/admin/substitute/reject/<int:response_id>', methods=['POST'])
+@bp.route('/admin/substitute/reject/<int:response_id>', methods=['POST'])
 @login_required
 def reject_substitute(response_id):
     if not current_user.is_admin: abort(403)
@@ -669,13 +2388,14 @@ def reject_substitute(response_id):
     schedule_id_redirect = response.schedule_id
     original_delegated_user = response.delegated_user # Get user before potentially changing
 
-    if not original_delegated_user or response.response_status not in ['delegated', 'sub_confirmed']:
-        flash("ไม่สามารถปฏิเสธตัวแทนได้ (สถานะไม่ถูกต้อง หรือ ไม่มีผู้รับมอบสิทธิ์)", "danger")
-        return redirect(url_for('admin_dashboard', schedule_id=schedule_id_redirect))
+    if not original_delegated_user or response.response_status not in ACTIVE_DELEGATION_STATUSES:
+        return _action_reply(schedule_id_redirect, "ไม่สามารถปฏิเสธตัวแทนได้ (สถานะไม่ถูกต้อง หรือ ไม่มีผู้รับมอบสิทธิ์)", "danger", 409)
 
     try:
+        old_status = response.response_status
         response.response_status = 'sub_declined'
         response.let_admin_decide = True
+        record_response_transition(response, old_status, response.delegated_to_user_id, response.schedule.ot_date)
         # Keep delegated_to_user_id for record, or set to None if admin should reassign blank
         # response.delegated_to_user_id = None # Optional: Clear assignment
         db.session.commit()
@@ -688,18 +2408,19 @@ def reject_substitute(response_id):
             f"‼️ Admin: กรุณาหาคนใหม่แทน"
         )
         send_line_push_message(message_to_group)
-        flash("ปฏิเสธตัวแทนแล้ว (ระบบจะคืนสถานะให้ Admin เลือกคนใหม่)", "warning")
+        return _action_reply(schedule_id_redirect, "ปฏิเสธตัวแทนแล้ว (ระบบจะคืนสถานะให้ Admin เลือกคนใหม่)", "warning", response=response)
 
+    except StaleDataError:
+         db.session.rollback()
+         return _action_reply(schedule_id_redirect, STALE_RESPONSE_MESSAGE, "warning", 409)
     except Exception as e:
          db.session.rollback()
-         flash(f"เกิดข้อผิดพลาดในการปฏิเสธตัวแทน: {e}", "danger")
-         app.logger.error(f"Error rejecting substitute for response {response_id}: {e}")
-
-    return redirect(url_for('admin_dashboard', schedule_id=schedule_id_redirect))
+         current_app.logger.error(f"Error rejecting substitute for response {response_id}: {e}")
+         return _action_reply(schedule_id_redirect, f"เกิดข้อผิดพลาดในการปฏิเสธตัวแทน: {e}", "danger", 500)
 
 
 # ฟังก์ชัน Admin เลือกตัวแทน
-@app.route('/admin/assign-substitute/<int:response_id>', methods=['POST'])
+@bp.route('/admin/assign-substitute/<int:response_id>', methods=['POST'])
 @login_required
 def assign_substitute(response_id):
     if not current_user.is_admin: abort(403)
@@ -707,21 +2428,18 @@ def assign_substitute(response_id):
     schedule_id_redirect = response.schedule_id
 
     if response.response_status not in ['declined_admin', 'sub_declined']:
-        flash("ไม่สามารถมอบหมายได้ (สถานะไม่ถูกต้อง)", "danger")
-        return redirect(url_for('admin_dashboard', schedule_id=schedule_id_redirect))
+        return _action_reply(schedule_id_redirect, "ไม่สามารถมอบหมายได้ (สถานะไม่ถูกต้อง)", "danger", 409)
 
     try:
         # Check if user_id exists in the form data and is not empty
         if 'user_id' not in request.form or not request.form['user_id']:
-             flash("กรุณาเลือกพนักงานที่จะมอบหมาย", "warning")
-             return redirect(url_for('admin_dashboard', schedule_id=schedule_id_redirect))
+             return _action_reply(schedule_id_redirect, "กรุณาเลือกพนักงานที่จะมอบหมาย", "warning", 400)
 
         sub_user_id = int(request.form['user_id'])
         sub_user = User.query.get(sub_user_id)
 
         if not sub_user:
-             flash("ไม่พบพนักงานที่เลือก", "danger")
-             return redirect(url_for('admin_dashboard', schedule_id=schedule_id_redirect))
+             return _action_reply(schedule_id_redirect, "ไม่พบพนักงานที่เลือก", "danger", 400)
 
         # Check if the selected user is already assigned or a primary user in this schedule
         existing_primary = OTResponse.query.filter(
@@ -732,18 +2450,19 @@ def assign_substitute(response_id):
         existing_assignment = OTResponse.query.filter(
             OTResponse.schedule_id == response.schedule_id,
             OTResponse.delegated_to_user_id == sub_user_id,
-            OTResponse.response_status.in_(['delegated', 'sub_confirmed']),
+            OTResponse.response_status.in_(ACTIVE_DELEGATION_STATUSES),
             OTResponse.id != response_id # Exclude the current response itself if it was sub_declined
         ).first()
 
         if existing_primary or existing_assignment:
-            flash(f"เลือกตัวแทนซ้ำ! ({sub_user.full_name} มีส่วนร่วมใน OT นี้แล้ว)", "danger")
-            return redirect(url_for('admin_dashboard', schedule_id=schedule_id_redirect))
+            return _action_reply(schedule_id_redirect, f"เลือกตัวแทนซ้ำ! ({sub_user.full_name} มีส่วนร่วมใน OT นี้แล้ว)", "danger", 409)
 
         # --- อัปเดตสถานะ ---
+        old_status, old_delegated_id = response.response_status, response.delegated_to_user_id
         response.delegated_to_user_id = sub_user_id
         response.response_status = 'sub_confirmed' # ยืนยันเลย (เพราะ Admin เป็นคนเลือกเอง)
         response.let_admin_decide = False
+        record_response_transition(response, old_status, old_delegated_id, response.schedule.ot_date)
         db.session.commit()
 
         # --- แจ้งเตือน LINE ---
@@ -755,21 +2474,53 @@ def assign_substitute(response_id):
             f"(Admin: {current_user.full_name})"
         )
         send_line_push_message(message_to_group)
-        flash(f"มอบหมายให้ {sub_user.full_name} เรียบร้อยแล้ว", "success")
+        return _action_reply(schedule_id_redirect, f"มอบหมายให้ {sub_user.full_name} เรียบร้อยแล้ว", "success", response=response)
 
     except ValueError:
-         flash("ข้อมูลที่ส่งมาไม่ถูกต้อง (User ID)", "danger")
-         return redirect(url_for('admin_dashboard', schedule_id=schedule_id_redirect))
+         return _action_reply(schedule_id_redirect, "ข้อมูลที่ส่งมาไม่ถูกต้อง (User ID)", "danger", 400)
+    except StaleDataError:
+        db.session.rollback()
+        return _action_reply(schedule_id_redirect, STALE_RESPONSE_MESSAGE, "warning", 409)
+    except IntegrityError:
+        # อีก request มอบหมายคนเดียวกันไปพร้อมกัน: unique index กันไว้
+        db.session.rollback()
+        return _action_reply(schedule_id_redirect, "เลือกตัวแทนซ้ำ! (พนักงานคนนี้เพิ่งถูกเลือกในวันเดียวกัน)", "danger", 409)
     except Exception as e:
         db.session.rollback()
-        flash(f"เกิดข้อผิดพลาดในการมอบหมาย: {str(e)}", "danger")
-        app.logger.error(f"Error assigning substitute for response {response_id}: {e}")
+        current_app.logger.error(f"Error assigning substitute for response {response_id}: {e}")
+        return _action_reply(schedule_id_redirect, f"เกิดข้อผิดพลาดในการมอบหมาย: {str(e)}", "danger", 500)
+
+
+# เงื่อนไขกรอง OTTally อย่างเดียว: ผู้เรียกตรวจเดือน/สัปดาห์มาก่อนแล้ว (month_bounds / iso_week_bounds)
+def monthly_tally_filters(year, month):
+    return (OTTally.year == year, OTTally.month == month)
+
+def weekly_tally_filters(iso_year, iso_week):
+    return (OTTally.iso_year == iso_year, OTTally.iso_week == iso_week)
+
+def ot_tally_query(*filters):
+    return db.session.query(
+        OTTally.user_id, OTTally.dates, User.full_name
+    ).outerjoin(
+        User, OTTally.user_id == User.id
+    ).filter(*filters)
 
-    return redirect(url_for('admin_dashboard', schedule_id=schedule_id_redirect))
+def summarize_ot_tally(*filters):
+    """รวมแถว OTTally ตามพนักงาน -> [{'name', 'dates'}] เรียงตามจำนวนครั้ง (มาก -> น้อย)"""
+    rows = ot_tally_query(*filters).all()
+
+    summary = {}
+    for user_id, dates, full_name in rows:
+        item = summary.setdefault(user_id, {'name': full_name or f"User ID: {user_id}", 'dates': []})
+        item['dates'].extend(date.fromisoformat(d) for d in dates.split(',') if d)
+
+    for item in summary.values():
+        item['dates'].sort()
+    return sorted(summary.values(), key=lambda item: len(item['dates']), reverse=True)
 
 
 # หน้ารายงาน
-@app.route('/admin/reports')
+@bp.route('/admin/reports')
 @login_required
 def admin_reports():
     if not current_user.is_admin: abort(403)
@@ -784,102 +2535,40 @@ def admin_reports():
         selected_year = int(request.args.get('year', current_year))
         selected_month = int(request.args.get('month', current_month))
         selected_week = int(request.args.get('week', current_week))
+        month_bounds(selected_year, selected_month) # เดือนต้องอยู่ใน 1-12
     except ValueError:
         flash("ค่าตัวกรองไม่ถูกต้อง", "danger")
         selected_year = current_year
         selected_month = current_month
         selected_week = current_week
 
-    # --- 2. Logic สรุปผลรายเดือน ---
-    monthly_summary = {}
+    # ตรวจสัปดาห์ ISO ครั้งเดียวตรงนี้ (เช่น ปีที่มี 52 สัปดาห์ไม่มีสัปดาห์ที่ 53): รายเดือนยังแสดงได้ตามปกติ
+    try:
+        week_start, week_end = iso_week_bounds(selected_year, selected_week)
+    except ValueError:
+        week_start = week_end = None
+        flash(f"ไม่สามารถคำนวณช่วงวันที่สำหรับสัปดาห์ที่ {selected_week} ปี {selected_year}", "warning")
+
+    # --- 2. Logic สรุปผลรายเดือน (อ่านจากตารางสรุป OTTally) ---
     sorted_monthly_summary = []
     try:
-        monthly_responses = db.session.query(
-            OTResponse, OTSchedule,
-            User.full_name.label('primary_name'),
-            User_sub.full_name.label('sub_name')
-        ).join(
-            OTSchedule, OTResponse.schedule_id == OTSchedule.id
-        ).join(
-            User, OTResponse.primary_user_id == User.id
-        ).outerjoin(
-            User_sub, OTResponse.delegated_to_user_id == User_sub.id
-        ).filter(
-            extract('year', OTSchedule.ot_date) == selected_year,
-            extract('month', OTSchedule.ot_date) == selected_month,
-            OTResponse.response_status.in_(['confirmed', 'sub_confirmed'])
-        ).order_by(OTSchedule.ot_date.asc()).all()
-
-        for resp, schedule, primary_name, sub_name in monthly_responses:
-            user_name = None # Use None initially
-
-            if resp.response_status == 'confirmed':
-                user_name = primary_name
-            elif resp.response_status == 'sub_confirmed':
-                user_name = sub_name if sub_name else f"User ID: {resp.delegated_to_user_id or 'Unknown'}" # Handle missing sub_name
-
-            if user_name:
-                if user_name not in monthly_summary:
-                    monthly_summary[user_name] = {'name': user_name, 'dates': []}
-                monthly_summary[user_name]['dates'].append(schedule.ot_date)
-
-        sorted_monthly_summary = sorted(monthly_summary.values(), key=lambda item: len(item['dates']), reverse=True)
+        sorted_monthly_summary = summarize_ot_tally(*monthly_tally_filters(selected_year, selected_month))
     except Exception as e:
         flash(f"เกิดข้อผิดพลาดในการดึงข้อมูลรายเดือน: {e}", "danger")
         print(f"Error fetching monthly report: {e}") # Log the error
 
 
     # --- 3. Logic สรุปผลรายสัปดาห์ ---
-    weekly_summary = {}
     sorted_weekly_summary = []
     week_range_str = f"(สัปดาห์ที่ {selected_week})" # Default week string
-    try:
-        # PostgreSQL uses 'week', SQLite might need adjustments or different approach
-        week_filter_column = extract('week', OTSchedule.ot_date)
-        # For ISO week standard used by isocalendar(), PostgreSQL also supports 'isoyear'
-        year_filter_column = extract('isoyear', OTSchedule.ot_date)
-
-        weekly_responses = db.session.query(
-            OTResponse, OTSchedule,
-            User.full_name.label('primary_name'),
-            User_sub.full_name.label('sub_name')
-        ).join(
-            OTSchedule, OTResponse.schedule_id == OTSchedule.id
-        ).join(
-            User, OTResponse.primary_user_id == User.id
-        ).outerjoin(
-            User_sub, OTResponse.delegated_to_user_id == User_sub.id
-        ).filter(
-            year_filter_column == selected_year, # Use ISO year
-            week_filter_column == selected_week,
-            OTResponse.response_status.in_(['confirmed', 'sub_confirmed'])
-        ).order_by(OTSchedule.ot_date.asc()).all()
-
-        for resp, schedule, primary_name, sub_name in weekly_responses:
-            user_name = None
-            if resp.response_status == 'confirmed':
-                user_name = primary_name
-            elif resp.response_status == 'sub_confirmed':
-                 user_name = sub_name if sub_name else f"User ID: {resp.delegated_to_user_id or 'Unknown'}"
-
-            if user_name:
-                if user_name not in weekly_summary:
-                    weekly_summary[user_name] = {'name': user_name, 'dates': []}
-                weekly_summary[user_name]['dates'].append(schedule.ot_date)
-
-        sorted_weekly_summary = sorted(weekly_summary.values(), key=lambda item: len(item['dates']), reverse=True)
-
-        # Calculate week range string (moved inside try) - using ISO standard week definition
-        # Monday is 1, Sunday is 7
-        week_start = datetime.strptime(f'{selected_year}-W{selected_week}-1', "%G-W%V-%u").date()
-        week_end = datetime.strptime(f'{selected_year}-W{selected_week}-7', "%G-W%V-%u").date()
-        week_range_str = f"{week_start.strftime('%d/%m')} - {week_end.strftime('%d/%m/%Y')}"
-
-    except ValueError:
-         flash(f"ไม่สามารถคำนวณช่วงวันที่สำหรับสัปดาห์ที่ {selected_week} ปี {selected_year}", "warning")
-    except Exception as e:
-        flash(f"เกิดข้อผิดพลาดในการดึงข้อมูลรายสัปดาห์: {e}", "danger")
-        print(f"Error fetching weekly report: {e}") # Log the error
+    if week_start is not None:
+        try:
+            # ใช้ปี/สัปดาห์แบบ ISO เหมือน isocalendar()
+            sorted_weekly_summary = summarize_ot_tally(*weekly_tally_filters(selected_year, selected_week))
+            week_range_str = f"{week_start.strftime('%d/%m')} - {(week_end - timedelta(days=1)).strftime('%d/%m/%Y')}"
+        except Exception as e:
+            flash(f"เกิดข้อผิดพลาดในการดึงข้อมูลรายสัปดาห์: {e}", "danger")
+            print(f"Error fetching weekly report: {e}") # Log the error
 
     # --- 4. ส่งข้อมูลไปที่ Template ---
     first_schedule = OTSchedule.query.order_by(OTSchedule.ot_date.asc()).first()
@@ -901,13 +2590,511 @@ def admin_reports():
                           )
 
 
+# (ใหม่) ตาราง OT แบบ พนักงาน x สัปดาห์ (หรือ x เดือน) ของช่วงวันที่ใดๆ ใน request เดียว
+REPORT_MATRIX_MAX_DAYS = 731
+REPORT_MATRIX_PERIODS = ('week', 'month')
+
+def _matrix_columns(start_date, end_date, period):
+    """คอลัมน์ทั้งหมดในช่วง (รวมช่วงที่ไม่มี OT) -> [(key, label, start, end)]"""
+    columns = []
+    if period == 'week':
+        iso_year, iso_week, _ = start_date.isocalendar()
+        col_start, col_end = iso_week_bounds(iso_year, iso_week)
+        while col_start <= end_date:
+            iso_year, iso_week, _ = col_start.isocalendar()
+            key = f"{iso_year}-W{iso_week:02d}"
+            label = f"{col_start.strftime('%d/%m')} - {(col_end - timedelta(days=1)).strftime('%d/%m')}"
+            columns.append((key, label, col_start, col_end))
+            col_start, col_end = col_end, col_end + timedelta(days=7)
+    else:
+        year, month = start_date.year, start_date.month
+        while date(year, month, 1) <= end_date:
+            col_start, col_end = month_bounds(year, month)
+            columns.append((f"{year}-{month:02d}", f"{calendar.month_abbr[month]} {year}", col_start, col_end))
+            year, month = col_end.year, col_end.month
+    return columns
+
+def _matrix_key(ot_date, period):
+    if period == 'week':
+        iso_year, iso_week, _ = ot_date.isocalendar()
+        return f"{iso_year}-W{iso_week:02d}"
+    return f"{ot_date.year}-{ot_date.month:02d}"
+
+def build_ot_matrix(start_date, end_date, period):
+    """นับ OT ที่ยืนยันแล้ว (คนที่มาทำจริง) ต่อพนักงานต่อช่วง ด้วย GROUP BY query เดียว
+    แล้วรวมยอดแถว/คอลัมน์ในรอบเดียว"""
+    rows = db.session.query(
+        effective_ot_user_id_column, User.full_name, OTSchedule.ot_date, func.count(OTResponse.id)
+    ).join(
+        OTSchedule, OTResponse.schedule_id == OTSchedule.id
+    ).outerjoin(
+        User, User.id == effective_ot_user_id_column
+    ).filter(
+        ot_date_in_range(start_date, end_date + timedelta(days=1)),
+        OTResponse.response_status.in_(CONFIRMED_STATUSES)
+    ).group_by(
+        effective_ot_user_id_column, User.full_name, OTSchedule.ot_date
+    ).all()
+
+    columns = _matrix_columns(start_date, end_date, period)
+    column_index = {key: i for i, (key, _, _, _) in enumerate(columns)}
+    column_totals = [0] * len(columns)
+    per_user = {}
+    total = 0
+    for user_id, full_name, ot_date, count in rows:
+        entry = per_user.get(user_id)
+        if entry is None:
+            entry = per_user[user_id] = {
+                'user_id': user_id,
+                'name': full_name or f"User ID: {user_id}",
+                'counts': [0] * len(columns),
+                'total': 0
+            }
+        i = column_index[_matrix_key(ot_date, period)]
+        entry['counts'][i] += count
+        entry['total'] += count
+        column_totals[i] += count
+        total += count
+
+    return {
+        'start': start_date.strftime('%Y-%m-%d'),
+        'end': end_date.strftime('%Y-%m-%d'),
+        'period': period,
+        'columns': [{'key': key, 'label': label} for key, label, _, _ in columns],
+        'rows': sorted(per_user.values(), key=lambda item: (-item['total'], item['name'])),
+        'column_totals': column_totals,
+        'total': total
+    }
+
+def _parse_matrix_args(default_start=None, default_end=None):
+    """อ่าน start/end/period จาก query string -> (start, end, period) หรือ ValueError พร้อมข้อความ"""
+    try:
+        start_arg = request.args.get('start') or default_start
+        end_arg = request.args.get('end') or default_end
+        start_date = datetime.strptime(start_arg, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_arg, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValueError("กรุณาระบุ start และ end ในรูปแบบ YYYY-MM-DD")
+    period = request.args.get('period', 'week')
+    if period not in REPORT_MATRIX_PERIODS:
+        raise ValueError("period ต้องเป็น week หรือ month")
+    if end_date < start_date or (end_date - start_date).days > REPORT_MATRIX_MAX_DAYS:
+        raise ValueError(f"ช่วงวันที่ไม่ถูกต้อง (ไม่เกิน {REPORT_MATRIX_MAX_DAYS} วัน)")
+    return start_date, end_date, period
+
+def _conditional(response):
+    """ETag จากเนื้อหา: ถ้าเหมือนที่ browser มีอยู่แล้วตอบ 304 (ไม่ต้องส่งข้อมูลซ้ำ)"""
+    response.add_etag()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+@bp.route('/api/reports/matrix')
+@login_required
+def report_matrix_api():
+    if not current_user.is_admin: abort(403)
+    try:
+        start_date, end_date, period = _parse_matrix_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return _conditional(jsonify(build_ot_matrix(start_date, end_date, period)))
+
+@bp.route('/admin/reports/matrix')
+@login_required
+def admin_report_matrix():
+    if not current_user.is_admin: abort(403)
+    this_year = date.today().year
+    try:
+        start_date, end_date, period = _parse_matrix_args(f"{this_year}-01-01", f"{this_year}-12-31")
+    except ValueError as e:
+        flash(str(e), "danger")
+        start_date, end_date, period = date(this_year, 1, 1), date(this_year, 12, 31), 'week'
+
+    matrix = build_ot_matrix(start_date, end_date, period)
+    return _conditional(make_response(render_template('report_matrix.html', matrix=matrix)))
+
+# (ใหม่) Export ประวัติ OT ที่ยืนยันแล้ว (CSV / XLSX) แบบ stream ทีละช่วง ไม่โหลดทั้งหมดเข้าหน่วยความจำ
+EXPORT_YIELD_PER = 500
+EXPORT_COLUMNS = ['วันที่ OT', 'ปี-สัปดาห์ (ISO)', 'รหัสพนักงาน', 'พนักงานที่ทำ OT', 'สถานะ', 'ผู้มีสิทธิ์หลัก', 'Response ID']
+
+def iter_confirmed_ot(start_date, end_date):
+    """ไล่แถว OT ที่ยืนยันแล้วในช่วง [start_date, end_date] เรียงตามวันที่ ด้วย server-side cursor (yield_per)"""
+    Worker = db.aliased(User, name='worker')
+    Primary = db.aliased(User, name='primary')
+    query = db.session.query(
+        OTSchedule.ot_date, effective_ot_user_id_column, Worker.full_name,
+        OTResponse.response_status, Primary.full_name, OTResponse.id
+    ).join(
+        OTSchedule, OTResponse.schedule_id == OTSchedule.id
+    ).outerjoin(
+        Worker, Worker.id == effective_ot_user_id_column
+    ).outerjoin(
+        Primary, Primary.id == OTResponse.primary_user_id
+    ).filter(
+        ot_date_in_range(start_date, end_date + timedelta(days=1)),
+        OTResponse.response_status.in_(CONFIRMED_STATUSES)
+    ).order_by(
+        OTSchedule.ot_date.asc(), OTResponse.id.asc()
+    ).execution_options(yield_per=EXPORT_YIELD_PER, stream_results=True)
+
+    for ot_date, user_id, worker_name, status, primary_name, response_id in query:
+        iso_year, iso_week, _ = ot_date.isocalendar()
+        yield [
+            ot_date.strftime('%Y-%m-%d'), f"{iso_year}-W{iso_week:02d}", user_id,
+            worker_name or f"User ID: {user_id}", status, primary_name or '', response_id
+        ]
+
+def generate_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    yield '\ufeff' # BOM ให้ Excel อ่านภาษาไทยถูก
+    writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() > 16384:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _ChunkSink(io.RawIOBase):
+    """ปลายทางให้ zipfile เขียนลง (ไม่ seek ได้) แล้วดึงไบต์ที่เขียนแล้วออกไปส่งทีละก้อน"""
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+XLSX_STATIC_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="OT" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+def _xlsx_row(values):
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append('<c/>') # ช่องว่างเหมือน CSV (ข้ามไม่ได้: cell ไม่มี r= จึงนับตำแหน่งตามลำดับ)
+        elif isinstance(value, int):
+            cells.append(f'<c><v>{value}</v></c>')
+        else:
+            cells.append(f'<c t="inlineStr"><is><t>{xml_escape(str(value))}</t></is></c>')
+    return f'<row>{"".join(cells)}</row>'
+
+def generate_xlsx(rows):
+    """เขียนไฟล์ .xlsx (zip) ทีละแถวลง _ChunkSink แล้ว yield ไบต์ออกไปทันที"""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as xlsx:
+        for name, content in XLSX_STATIC_PARTS.items():
+            xlsx.writestr(name, content)
+        yield sink.drain()
+
+        with xlsx.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + _xlsx_row(EXPORT_COLUMNS)
+            ).encode('utf-8'))
+            for i, row in enumerate(rows, 1):
+                sheet.write(_xlsx_row(row).encode('utf-8'))
+                if i % EXPORT_YIELD_PER == 0:
+                    yield sink.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+EXPORT_FORMATS = {
+    'csv': (generate_csv, 'text/csv; charset=utf-8'),
+    'xlsx': (generate_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+@bp.route('/admin/reports/export.<fmt>')
+@login_required
+def export_ot_history(fmt):
+    if not current_user.is_admin: abort(403)
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    try:
+        start_date = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args['end'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return jsonify({"error": "กรุณาระบุ start และ end ในรูปแบบ YYYY-MM-DD"}), 400
+    if end_date < start_date:
+        return jsonify({"error": "ช่วงวันที่ไม่ถูกต้อง"}), 400
+
+    generate, mimetype = EXPORT_FORMATS[fmt]
+    filename = f"ot_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.{fmt}"
+    return Response(
+        stream_with_context(generate(iter_confirmed_ot(start_date, end_date))),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+# (ใหม่) Server-Sent Events ของตาราง OT: ส่งเฉพาะแถวที่เปลี่ยน + สรุปยอด ให้ Dashboard ที่เปิดค้างไว้
+SSE_POLL_SECONDS = float(os.environ.get('SSE_POLL_SECONDS', 2))
+SSE_KEEPALIVE_SECONDS = 15
+# ปิด stream เป็นระยะ (browser ต่อใหม่เองพร้อม Last-Event-ID) ไม่ให้จอง worker thread ไว้ตลอด
+SSE_MAX_SECONDS = float(os.environ.get('SSE_MAX_SECONDS', 300))
+
+def last_schedule_change_id(schedule_id):
+    return db.session.query(func.max(OTResponseChange.id)).filter(
+        OTResponseChange.schedule_id == schedule_id
+    ).scalar() or 0
+
+def _sse(event_name, data, event_id=None):
+    message = f"event: {event_name}\ndata: {json.dumps(data, ensure_ascii=False)}\n"
+    if event_id is not None:
+        message = f"id: {event_id}\n" + message
+    return message + "\n"
+
+def _schedule_event_stream(schedule_id, last_change_id):
+    started = last_sent = time.monotonic()
+    generation = change_notifier.generation
+    yield f"retry: {int(SSE_POLL_SECONDS * 1000)}\n\n"
+
+    while time.monotonic() - started < SSE_MAX_SECONDS:
+        changes = OTResponseChange.query.filter(
+            OTResponseChange.schedule_id == schedule_id,
+            OTResponseChange.id > last_change_id
+        ).order_by(OTResponseChange.id.asc()).all()
+
+        if changes:
+            last_change_id = changes[-1].id
+            if any(change.new_status == 'deleted' for change in changes):
+                yield _sse('deleted', {"schedule_id": schedule_id}, last_change_id)
+                return
+
+            # ส่งสถานะ "ปัจจุบัน" ของแต่ละแถว (ถ้าเปลี่ยนหลายครั้งระหว่างรอบ ส่งครั้งเดียว)
+            response_ids = list(dict.fromkeys(change.response_id for change in changes))
+            responses = OTResponse.query.options(
+                joinedload(OTResponse.primary_user),
+                joinedload(OTResponse.delegated_user),
+                joinedload(OTResponse.schedule)
+            ).filter(OTResponse.id.in_(response_ids)).all()
+            substitutes = find_substitute_candidates(schedule_id)
+            for response in responses:
+                row_html = render_template('_response_row.html', r=response, row_number='',
+                                           selected_schedule=response.schedule, available_substitutes=substitutes)
+                yield _sse('response', {"response_id": response.id, "row_html": row_html}, last_change_id)
+            yield _sse('summary', {"summary": get_schedule_summary(schedule_id), "substitutes": substitutes}, last_change_id)
+            last_sent = time.monotonic()
+        elif time.monotonic() - last_sent >= SSE_KEEPALIVE_SECONDS:
+            yield ": keepalive\n\n"
+            last_sent = time.monotonic()
+
+        db.session.close() # ไม่ถือ transaction/connection ค้างไว้ระหว่างรอ
+        generation = change_notifier.wait(generation, SSE_POLL_SECONDS)
+
+@bp.route('/api/schedules/<int:schedule_id>/events')
+@login_required
+def schedule_events(schedule_id):
+    if not current_user.is_admin: abort(403)
+    OTSchedule.query.get_or_404(schedule_id)
+
+    # ต่อใหม่: Last-Event-ID จาก browser, เปิดหน้าใหม่: ?since= = change ล่าสุดตอน render หน้า
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    if last_event_id is None:
+        last_event_id = request.args.get('since', type=int)
+    if last_event_id is None:
+        last_event_id = last_schedule_change_id(schedule_id)
+    db.session.close()
+
+    return Response(
+        stream_with_context(_schedule_event_stream(schedule_id, last_event_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# (ใหม่) สรุปจำนวนตามสถานะด้วย GROUP BY (ใช้ทั้งใน Dashboard และ JSON API)
+STATUS_SUMMARY_GROUPS = {
+    'confirmed': ('confirmed', 'sub_confirmed'),
+    'declined': ('declined_admin', 'sub_declined'),
+    'pending': ('pending', 'delegated'),
+}
+SUMMARY_RANGE_MAX_DAYS = 366
+
+def _build_status_summary(status_counts):
+    summary = {group: sum(status_counts.get(s, 0) for s in statuses)
+               for group, statuses in STATUS_SUMMARY_GROUPS.items()}
+    summary['total'] = sum(status_counts.values())
+    summary['by_status'] = status_counts
+    return summary
+
+def get_schedule_summary(schedule_id):
+    rows = db.session.query(
+        OTResponse.response_status, func.count(OTResponse.id)
+    ).filter(
+        OTResponse.schedule_id == schedule_id
+    ).group_by(OTResponse.response_status).all()
+    return _build_status_summary({(status or 'pending'): count for status, count in rows})
+
+def get_schedule_summaries(start_date, end_date):
+    """สรุปของทุกตารางในช่วง [start_date, end_date] ด้วย query เดียว"""
+    rows = db.session.query(
+        OTSchedule.id, OTSchedule.ot_date, OTResponse.response_status, func.count(OTResponse.id)
+    ).outerjoin(
+        OTResponse, OTResponse.schedule_id == OTSchedule.id
+    ).filter(
+        ot_date_in_range(start_date, end_date + timedelta(days=1))
+    ).group_by(
+        OTSchedule.id, OTSchedule.ot_date, OTResponse.response_status
+    ).order_by(OTSchedule.ot_date.asc()).all()
+
+    per_schedule = {}
+    for schedule_id, ot_date, status, count in rows:
+        entry = per_schedule.setdefault(schedule_id, {'ot_date': ot_date, 'counts': {}})
+        if count:
+            entry['counts'][status or 'pending'] = count
+    return [
+        dict(schedule_id=schedule_id, ot_date=entry['ot_date'].strftime('%Y-%m-%d'), **_build_status_summary(entry['counts']))
+        for schedule_id, entry in per_schedule.items()
+    ]
+
+@bp.route('/api/schedules/<int:schedule_id>/summary')
+@login_required
+def schedule_summary(schedule_id):
+    if not current_user.is_admin: abort(403)
+    schedule = OTSchedule.query.get_or_404(schedule_id)
+    return jsonify(dict(
+        schedule_id=schedule.id,
+        ot_date=schedule.ot_date.strftime('%Y-%m-%d'),
+        **get_schedule_summary(schedule.id)
+    ))
+
+@bp.route('/api/schedules/summary')
+@login_required
+def schedule_summary_range():
+    if not current_user.is_admin: abort(403)
+    try:
+        start_date = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args['end'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return jsonify({"error": "กรุณาระบุ start และ end ในรูปแบบ YYYY-MM-DD"}), 400
+    if end_date < start_date or (end_date - start_date).days > SUMMARY_RANGE_MAX_DAYS:
+        return jsonify({"error": f"ช่วงวันที่ไม่ถูกต้อง (ไม่เกิน {SUMMARY_RANGE_MAX_DAYS} วัน)"}), 400
+
+    schedules = get_schedule_summaries(start_date, end_date)
+    return jsonify({
+        "start": start_date.strftime('%Y-%m-%d'),
+        "end": end_date.strftime('%Y-%m-%d'),
+        "schedules": schedules
+    })
+
+
+# (ใหม่) Change feed: ระบบภายนอก (เช่น HR) ดึงเฉพาะการเปลี่ยนแปลงใหม่ต่อจาก cursor ล่าสุดที่เคยได้
+CHANGES_API_TOKEN = os.environ.get('CHANGES_API_TOKEN')
+CHANGES_PAGE_SIZE_DEFAULT = 100
+CHANGES_PAGE_SIZE_MAX = 1000
+# id ถูกจองตอน INSERT (ทันทีก่อน commit) แต่ transaction ที่ได้ id น้อยกว่ายังอาจ commit หลังคนที่ได้ id มากกว่าเล็กน้อย
+# จึงยังไม่ส่งแถวที่ใหม่กว่า N วินาที เพื่อไม่ให้ cursor ข้ามแถวที่ commit ช้า
+CHANGES_SETTLE_SECONDS = float(os.environ.get('CHANGES_SETTLE_SECONDS', 2))
+
+def _changes_api_authorized():
+    """Admin ที่ Login อยู่ หรือส่ง Authorization: Bearer <CHANGES_API_TOKEN>"""
+    if current_user.is_authenticated and current_user.is_admin:
+        return True
+    auth = request.headers.get('Authorization', '')
+    if CHANGES_API_TOKEN and auth.startswith('Bearer '):
+        return hmac.compare_digest(auth[len('Bearer '):].encode('utf-8'), CHANGES_API_TOKEN.encode('utf-8'))
+    return False
+
+@bp.route('/api/changes')
+def list_changes():
+    if not _changes_api_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(max(int(request.args.get('limit', CHANGES_PAGE_SIZE_DEFAULT)), 1), CHANGES_PAGE_SIZE_MAX)
+    except ValueError:
+        return jsonify({"error": "since/limit ต้องเป็นตัวเลข"}), 400
+
+    # ดึงเกิน 1 แถวเพื่อรู้ว่ายังมีหน้าถัดไปไหม
+    changes = OTResponseChange.query.filter(
+        OTResponseChange.id > since,
+        OTResponseChange.changed_at <= datetime.utcnow() - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+    ).order_by(OTResponseChange.id.asc()).limit(limit + 1).all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    return jsonify({
+        "changes": [change.to_dict() for change in changes],
+        "next_cursor": str(changes[-1].id) if changes else str(since),
+        "has_more": has_more
+    })
+
+# (ใหม่) รายการตาราง OT สำหรับ dropdown แบบแบ่งหน้า (keyset ตาม ot_date ใหม่ -> เก่า)
+SCHEDULE_PAGE_SIZE_MAX = 100
+
+@bp.route('/api/schedules')
+@login_required
+def list_schedules():
+    if not current_user.is_admin: abort(403)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), SCHEDULE_PAGE_SIZE_MAX)
+    before_str = request.args.get('before')
+
+    query = OTSchedule.query
+    if before_str:
+        try:
+            before = datetime.strptime(before_str, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({"error": "รูปแบบวันที่ไม่ถูกต้อง (ต้องเป็น YYYY-MM-DD)"}), 400
+        query = query.filter(OTSchedule.ot_date < before)
+
+    # ดึงเกิน 1 แถวเพื่อรู้ว่ายังมีหน้าถัดไปหรือไม่
+    schedules = query.order_by(OTSchedule.ot_date.desc()).limit(limit + 1).all()
+    has_more = len(schedules) > limit
+    schedules = schedules[:limit]
+
+    return jsonify({
+        "items": [{
+            "id": s.id,
+            "ot_date": s.ot_date.strftime('%Y-%m-%d'),
+            "label": f"วันที่ {s.ot_date.strftime('%d/%m/%Y')} (สร้างเมื่อ: {s.created_at.strftime('%Y-%m-%d %H:%M')})"
+        } for s in schedules],
+        "next_before": schedules[-1].ot_date.strftime('%Y-%m-%d') if has_more else None
+    })
+
+
 # หน้า Dashboard หลัก
-@app.route('/admin')
+@bp.route('/admin')
 @login_required
 def admin_dashboard():
     if not current_user.is_admin: abort(403)
 
-    all_schedules = OTSchedule.query.order_by(OTSchedule.ot_date.desc()).all()
     schedule_id_to_show = request.args.get('schedule_id', type=int)
     search_date_str = request.args.get('search_date')
 
@@ -915,6 +3102,8 @@ def admin_dashboard():
     # error_message = None # Replaced by flash messages
     responses = []
     available_substitutes = [] # (V3)
+    summary = None
+    last_change_id = 0
 
     try:
         if schedule_id_to_show:
@@ -927,30 +3116,25 @@ def admin_dashboard():
             selected_schedule = OTSchedule.query.filter_by(ot_date=search_date).first()
             if not selected_schedule:
                 flash(f"ไม่พบตาราง OT สำหรับวันที่ {search_date.strftime('%d/%m/%Y')}", "info") # Use info, not error
-                # If search yields nothing, maybe default to latest? Or show empty.
-                # selected_schedule = all_schedules[0] if all_schedules else None
 
-        elif all_schedules:
-            selected_schedule = all_schedules[0]
+        else:
+            # ค่าเริ่มต้น: ตารางล่าสุด (รายการตารางทั้งหมดโหลดผ่าน /api/schedules ทีละหน้า)
+            selected_schedule = OTSchedule.query.order_by(OTSchedule.ot_date.desc()).first()
 
         # (V3) เพิ่ม Logic ค้นหาคนว่าง
         if selected_schedule:
-            responses = selected_schedule.responses
-
-            all_primary_user_ids = [r.primary_user_id for r in responses]
-
-            all_delegated_user_ids = [
-                r.delegated_to_user_id for r in responses
-                if r.delegated_to_user_id is not None and
-                   r.response_status in ['delegated', 'sub_confirmed']
-            ]
-
-            excluded_user_ids = list(set(all_primary_user_ids + all_delegated_user_ids))
-
-            available_substitutes = User.query.filter(
-                User.id.notin_(excluded_user_ids),
-                User.is_admin == False
-            ).order_by(User.full_name).all()
+            # อ่านก่อนโหลดแถว: อะไรที่เปลี่ยนหลังจากนี้ SSE จะส่งตามมา
+            last_change_id = last_schedule_change_id(selected_schedule.id)
+            # โหลดผู้มีสิทธิ์หลัก + ตัวแทน มาพร้อม responses (ไม่ lazy load ทีละแถวใน template)
+            responses = OTResponse.query.options(
+                joinedload(OTResponse.primary_user),
+                joinedload(OTResponse.delegated_user)
+            ).filter(
+                OTResponse.schedule_id == selected_schedule.id
+            ).order_by(OTResponse.id).all()
+
+            available_substitutes = find_substitute_candidates(selected_schedule.id)
+            summary = get_schedule_summary(selected_schedule.id)
 
     except ValueError:
         flash("รูปแบบวันที่ไม่ถูกต้อง (ต้องเป็น YYYY-MM-DD)", "danger")
@@ -958,25 +3142,28 @@ def admin_dashboard():
         selected_schedule = None
         responses = []
         available_substitutes = []
+        summary = None
     except Exception as e:
         flash(f"เกิดข้อผิดพลาด: {str(e)}", "danger")
-        app.logger.error(f"Error in admin_dashboard: {e}")
+        current_app.logger.error(f"Error in admin_dashboard: {e}")
         selected_schedule = None
         responses = []
         available_substitutes = []
+        summary = None
 
     # (V3) อัปเกรดการส่งค่า
     return render_template('admin.html',
-                           all_schedules=all_schedules,
                            selected_schedule=selected_schedule,
                            responses=responses,
                            available_substitutes=available_substitutes,
-                           search_date_str=search_date_str
+                           summary=summary,
+                           search_date_str=search_date_str,
+                           last_change_id=last_change_id
                            )
 
 
 # หน้า Setup Demo (ควรคอมเมนต์ออก)
-# @app.route('/setup-demo')
+# @bp.route('/setup-demo')
 # @login_required
 # def setup_demo():
 #     if not current_user.is_admin: abort(403)
@@ -995,7 +3182,7 @@ def admin_dashboard():
 #         db.session.commit()
 #
 #         flash("สร้างข้อมูล Demo สำเร็จ (ลบข้อมูลเก่าและสร้างพนักงาน 5 คน)", "success")
-#         return redirect(url_for('admin_users_page')) # Redirect to user page after setup
+#         return redirect(url_for('main.admin_users_page')) # Redirect to user page after setup
 #         # return f"""
 #         # <h1>สร้างข้อมูลพนักงาน 5 คนสำเร็จ!</h1>
 #         # <p>ลบข้อมูลตาราง OT และพนักงานเก่าทั้งหมด (ยกเว้น Admin) และสร้างรายชื่อพนักงาน 5 คนเรียบร้อยแล้ว</p>
@@ -1006,66 +3193,184 @@ def admin_dashboard():
 #     except Exception as e:
 #         db.session.rollback()
 #         flash(f"เกิดข้อผิดพลาดในการ Setup Demo: {e}", "danger")
-#         return redirect(url_for('admin_dashboard'))
-
-
-# Handler สำหรับรับข้อความ LINE
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event):
+#         return redirect(url_for('main.admin_dashboard'))
+
+
+# Handler สำหรับรับข้อความ LINE (ทั้ง payload พร้อมกัน)
+PENDING_OT_COMMAND = "ดูตาราง OT ที่ยังไม่ตอบ"
+
+def pending_ot_query(user_ids):
+    return db.session.query(
+        OTResponse.primary_user_id, OTResponse.id, OTResponse.schedule_id, OTSchedule.ot_date
+    ).join(OTSchedule).filter(
+        OTResponse.primary_user_id.in_(user_ids),
+        OTResponse.response_status == 'pending',
+        OTSchedule.ot_date >= date.today() # Only future/today's OT
+    ).order_by(OTSchedule.ot_date.asc())
+
+def handle_message_events(events):
+    """ตอบทุกข้อความใน payload: ดึง User และ OT ค้างตอบของทุกคนด้วย IN query อย่างละครั้ง
+    (จำนวน query ต่อ payload คงที่ ไม่ขึ้นกับจำนวน event)"""
+    command_line_ids = {event.source.user_id for event in events if event.message.text == PENDING_OT_COMMAND}
+
+    users_by_line_id = {}
+    pending_by_user_id = defaultdict(list)
+    if command_line_ids:
+        users = User.query.filter(User.line_user_id.in_(command_line_ids)).all()
+        users_by_line_id = {user.line_user_id: user for user in users}
+
+        if users:
+            pending_rows = pending_ot_query([user.id for user in users]).all()
+            for row in pending_rows:
+                pending_by_user_id[row.primary_user_id].append(row)
+
+    # ใช้ client ตัวเดียวกับ push (connection pool เดียวกัน); ตอบทุก event ใน payload พร้อมกัน
+    replies = [(event.reply_token, _build_reply_text(event, users_by_line_id, pending_by_user_id)) for event in events]
+    for event, error in zip(events, line_fanout('reply_text', replies)):
+        if error is not None:
+            print(f"!!! ไม่สามารถ 'ตอบกลับ' หา {event.source.user_id} ได้ (v3): {error}")
+
+def _build_reply_text(event, users_by_line_id, pending_by_user_id):
     user_id = event.source.user_id
     text = event.message.text
-    reply_text = ""
 
     # --- 1. ตรวจสอบ Logic ---
-    if text == "ดูตาราง OT ที่ยังไม่ตอบ":
-        user = User.query.filter_by(line_user_id=user_id).first()
+    if text == PENDING_OT_COMMAND:
+        user = users_by_line_id.get(user_id)
 
         if not user:
-            reply_text = "ไม่พบข้อมูลของคุณในระบบ กรุณาติดต่อ Admin เพื่อลงทะเบียน LINE User ID ครับ"
-        else:
-            pending_responses = db.session.query(OTResponse).join(OTSchedule).filter(
-                OTResponse.primary_user_id == user.id,
-                OTResponse.response_status == 'pending',
-                OTSchedule.ot_date >= date.today() # Only future/today's OT
-            ).order_by(OTSchedule.ot_date.asc()).all()
-
-            if not pending_responses:
-                reply_text = f"สวัสดีครับ คุณ {user.full_name}\n\nคุณไม่มียอด OT ค้างตอบครับ 👍"
-            else:
-                reply_text = f"สวัสดีครับ คุณ {user.full_name}\n\nคุณมี OT ที่ยังไม่ตอบ {len(pending_responses)} รายการ:\n\n"
-
-                with app.app_context():
-                    for resp in pending_responses:
-                        survey_link = url_for('show_survey', token=resp.token, _external=True)
-                        reply_text += (
-                            f"📅 วันที่: {resp.schedule.ot_date.strftime('%d/%m/%Y')}\n"
-                            f"🔗 ลิงก์: {survey_link}\n\n"
-                        )
-                reply_text = reply_text.strip() # Remove last newline
-
+            return "ไม่พบข้อมูลของคุณในระบบ กรุณาติดต่อ Admin เพื่อลงทะเบียน LINE User ID ครับ"
+
+        pending_responses = pending_by_user_id.get(user.id, [])
+        if not pending_responses:
+            return f"สวัสดีครับ คุณ {user.full_name}\n\nคุณไม่มียอด OT ค้างตอบครับ 👍"
+
+        reply_text = f"สวัสดีครับ คุณ {user.full_name}\n\nคุณมี OT ที่ยังไม่ตอบ {len(pending_responses)} รายการ:\n\n"
+        for resp in pending_responses:
+            survey_link = survey_url(resp.id, resp.schedule_id)
+            reply_text += (
+                f"📅 วันที่: {resp.ot_date.strftime('%d/%m/%Y')}\n"
+                f"🔗 ลิงก์: {survey_link}\n\n"
+            )
+        return reply_text.strip() # Remove last newline
+
+    # --- Logic เดิม: (ถ้าไม่ใช่คำสั่ง Rich Menu) ---
+    print(f"!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+    print(f"!!! USER ID ที่คุณตามหาคือ: {user_id}")
+    print(f"!!! เขาพิมพ์ว่า: {text}")
+    print(f"!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+
+    return f'นี่คือ User ID ของคุณ:\n{user_id}\n\nกรุณาคัดลอก ID นี้ไปให้ Admin ครับ'
+
+
+# --- 3.6 (ใหม่) ตรวจ query plan ของรายงานและ query ที่ใช้บ่อย ---
+def explain_query(query):
+    """คืน query plan (บรรทัดละ 1 ขั้น) ของ query บนฐานข้อมูลที่ใช้อยู่ (SQLite / PostgreSQL)"""
+    dialect = db.engine.dialect
+    sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+    return [' '.join(str(col) for col in row) for row in db.session.execute(text(prefix + sql))]
+
+def _plan_scans_table(plan, table):
+    """True ถ้า plan อ่านทั้งตาราง (ไม่ผ่าน index)"""
+    for line in plan:
+        if f'SCAN {table}' in line and 'INDEX' not in line: # SQLite
+            return True
+        if f'Seq Scan on {table}' in line: # PostgreSQL
+            return True
+    return False
+
+def report_query_checks(today=None):
+    today = today or date.today()
+    iso_year, iso_week, _ = today.isocalendar()
+    month_start, month_end = month_bounds(today.year, today.month)
+    return [
+        ('รายงานรายเดือน (OTTally)', 'ot_tally', ot_tally_query(*monthly_tally_filters(today.year, today.month))),
+        ('รายงานรายสัปดาห์ (OTTally)', 'ot_tally', ot_tally_query(*weekly_tally_filters(iso_year, iso_week))),
+        ('ตาราง OT ในช่วงวันที่', 'ot_schedule', OTSchedule.query.filter(ot_date_in_range(month_start, month_end))),
+    ]
+
+def hot_query_checks(schedule_id=1, user_ids=(1, 2)):
+    """query ที่ถูกเรียกบ่อย (ทุกตัวต้องไม่อ่าน ot_response ทั้งตาราง)"""
+    return [
+        ('สรุปสถานะของตาราง', 'ot_response', db.session.query(
+            OTResponse.response_status, func.count(OTResponse.id)
+        ).filter(OTResponse.schedule_id == schedule_id).group_by(OTResponse.response_status)),
+        ('ส่งเตือนคนที่ยังไม่ตอบ', 'ot_response', OTResponse.query.filter(
+            OTResponse.schedule_id == schedule_id,
+            OTResponse.response_status.in_(['pending', 'delegated'])
+        )),
+        ('ตรวจตัวแทนซ้ำ', 'ot_response', OTResponse.query.filter(
+            OTResponse.schedule_id == schedule_id,
+            OTResponse.delegated_to_user_id == user_ids[0],
+            OTResponse.response_status.in_(ACTIVE_DELEGATION_STATUSES)
+        )),
+        ('หาคนว่างเป็นตัวแทน', 'ot_response', substitute_candidates_query(schedule_id)),
+        ('LINE: OT ที่ยังไม่ตอบ', 'ot_response', pending_ot_query(list(user_ids))),
+        ('ลบผู้ใช้: เป็นผู้มีสิทธิ์หลัก', 'ot_response', OTResponse.query.filter_by(primary_user_id=user_ids[0])),
+        ('ลบผู้ใช้: เป็นตัวแทน', 'ot_response', OTResponse.query.filter_by(delegated_to_user_id=user_ids[0])),
+    ]
+
+def run_plan_checks(checks):
+    """พิมพ์ query plan ของแต่ละ check -> รายชื่อ check ที่ scan ทั้งตาราง"""
+    if db.engine.dialect.name == 'postgresql':
+        # ตารางเล็กๆ PostgreSQL จะเลือก Seq Scan เสมอ; ปิดไว้เพื่อดูว่า "ใช้ index ได้" หรือไม่
+        db.session.execute(text('SET LOCAL enable_seqscan = off'))
+
+    failed = []
+    for name, table, query in checks:
+        plan = explain_query(query)
+        print(f"== {name}")
+        for line in plan:
+            print(f"   {line}")
+        if _plan_scans_table(plan, table):
+            failed.append(name)
+    db.session.rollback()
+
+    if failed:
+        print(f"ไม่ใช้ index: {', '.join(failed)}")
     else:
-        # --- Logic เดิม: (ถ้าไม่ใช่คำสั่ง Rich Menu) ---
-        print(f"!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        print(f"!!! USER ID ที่คุณตามหาคือ: {user_id}")
-        print(f"!!! เขาพิมพ์ว่า: {text}")
-        print(f"!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-
-        reply_text = f'นี่คือ User ID ของคุณ:\n{user_id}\n\nกรุณาคัดลอก ID นี้ไปให้ Admin ครับ'
+        print("ทุก query ใช้ index")
+    return failed
+
+@bp.cli.command('explain-report-queries')
+def explain_report_queries_command():
+    """แสดง query plan ของรายงาน และตรวจว่าใช้ index (ไม่ scan ทั้งตาราง)"""
+    if run_plan_checks(report_query_checks()):
+        raise SystemExit(1)
+
+@bp.cli.command('explain-hot-queries')
+def explain_hot_queries_command():
+    """แสดง query plan ของ query ที่ใช้บ่อยบน ot_response และตรวจว่าใช้ index"""
+    if run_plan_checks(hot_query_checks()):
+        raise SystemExit(1)
+
+# --- 3.7 (ใหม่) Application factory ---
+def create_app(test_config=None):
+    """สร้าง Flask app: ไม่ตรวจ/สร้าง schema (ใช้ `flask db-upgrade`) และไม่สร้าง LINE client จนกว่าจะใช้จริง
+    gunicorn: `gunicorn -c gunicorn.conf.py "app:create_app()"` / CLI: `flask --app app <command>`
+    การกู้ Outbox ที่ค้างไม่ได้เริ่มที่นี่ แต่เริ่มใน worker ที่เสิร์ฟเว็บ (start_line_outbox_recovery)"""
+    app = Flask(__name__)
+    # FIX 3.1: ใช้ Environment Variable สำหรับ DATABASE_URL
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY')
+    if test_config:
+        app.config.update(test_config)
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+
+    if RUN_MIGRATIONS_ON_STARTUP:
+        with app.app_context():
+            try:
+                initialize_database()
+            except Exception as e:
+                # ไม่ให้แอปล่มทั้งระบบ: migration ที่ล้มจะถูกรันใหม่ตอนเริ่มครั้งถัดไป / db-upgrade
+                print(f"!!! Migration ไม่สำเร็จ: {e}")
 
-    # --- 2. ส่งการตอบกลับ ---
-    try:
-        # Use V3 API for replying
-        configuration = Configuration(access_token=YOUR_CHANNEL_ACCESS_TOKEN)
-        with ApiClient(configuration) as api_client:
-            line_bot_api_v3 = MessagingApi(api_client)
-            line_bot_api_v3.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[V3TextMessage(text=reply_text)]
-                )
-            )
-    except Exception as e:
-        print(f"!!! ไม่สามารถ 'ตอบกลับ' หา {user_id} ได้ (v3): {e}")
+    return app
 
 
 # --- 4. ส่วนสำหรับรัน Server ---
@@ -1074,4 +3379,6 @@ if __name__ == '__main__':
     # The PORT environment variable is automatically set by Render.
     port = int(os.environ.get('PORT', 5000))
     # Use host='0.0.0.0' to be accessible externally
+    app = create_app()
+    start_line_outbox_recovery(app)
     app.run(debug=False, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""เปรียบเทียบ latency ต่อการ reply 1 ครั้ง: สร้าง ApiClient ใหม่ทุกครั้ง (แบบเดิม) vs client ที่ใช้ร่วมกัน (pooled)
+
+ยิงไปที่ LINE stub บนเครื่อง (ไม่แตะ LINE จริง)
+
+    python bench/bench_reply_latency.py --requests 300 --latency-ms 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from fake_line_server import start_fake_line_server
+
+
+def _summary(name, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{name:<28} mean={statistics.mean(samples):7.2f}ms  p50={statistics.median(samples):7.2f}ms  p95={p95:7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, host = start_fake_line_server(latency_ms=args.latency_ms)
+
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    os.environ['NOTIFICATION_TRANSPORT'] = 'stub'
+    os.environ['LINE_STUB_URL'] = host
+    os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'bench-token')
+    os.environ.setdefault('LINE_CHANNEL_SECRET', 'bench-secret')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as ot_app
+    from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage
+
+    # แบบเดิม: Configuration + ApiClient + MessagingApi ใหม่ทุก reply
+    before = []
+    for i in range(args.requests):
+        started = time.perf_counter()
+        configuration = Configuration(access_token='bench-token', host=host)
+        with ApiClient(configuration) as api_client:
+            MessagingApi(api_client).reply_message(
+                ReplyMessageRequest(reply_token=f'token-{i}', messages=[TextMessage(text='hello')])
+            )
+        before.append((time.perf_counter() - started) * 1000)
+
+    # แบบใหม่: client ตัวเดียวผ่าน notification_transport
+    after = []
+    for i in range(args.requests):
+        started = time.perf_counter()
+        ot_app.notification_transport.reply_text(f'token-{i}', 'hello')
+        after.append((time.perf_counter() - started) * 1000)
+
+    print(f"{args.requests} replies, stub latency {args.latency_ms}ms")
+    _summary('new client per reply', before)
+    _summary('shared pooled client', after)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
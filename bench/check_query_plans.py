@@ -0,0 +1,88 @@
+"""สร้างข้อมูลจำนวนมากในฐานข้อมูลทดสอบ แล้วตรวจ query plan ของ query ที่ใช้บ่อยและรายงาน (ต้องใช้ index ทั้งหมด)
+
+ค่าเริ่มต้นใช้ SQLite ชั่วคราว; ถ้าจะตรวจบน PostgreSQL ให้ชี้ไปที่ฐานข้อมูลว่างสำหรับทดสอบ (ห้ามใช้ฐานจริง)
+
+    python bench/check_query_plans.py --users 2000 --schedules 1500
+    python bench/check_query_plans.py --database-url postgresql://localhost/ot_plan_check
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--schedules', type=int, default=1500)
+    parser.add_argument('--per-schedule', type=int, default=8)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+    if args.users < 2 * args.per_schedule:
+        parser.error('--users ต้องมีอย่างน้อย 2 เท่าของ --per-schedule (ผู้มีสิทธิ์หลัก + ตัวแทนที่ไม่ซ้ำกัน)')
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(tmpdir, 'plans.db')}"
+    os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'bench-token')
+    os.environ.setdefault('LINE_CHANNEL_SECRET', 'bench-secret')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as ot_app
+    db = ot_app.db
+
+    with ot_app.create_app().app_context():
+        db.create_all()
+        if ot_app.User.query.first():
+            sys.exit("ฐานข้อมูลนี้มีข้อมูลอยู่แล้ว: ใช้ฐานข้อมูลว่างสำหรับทดสอบเท่านั้น")
+
+        started = time.perf_counter()
+        rng = random.Random(42)
+        db.session.execute(db.insert(ot_app.User), [
+            {'username': f'user{i}', 'full_name': f'User {i}', 'is_admin': False,
+             'line_user_id': f'U{i:032d}' if i % 3 else None}
+            for i in range(args.users)
+        ])
+        user_ids = [row[0] for row in db.session.query(ot_app.User.id)]
+
+        first_day = date.today() - timedelta(days=args.schedules // 2)
+        db.session.execute(db.insert(ot_app.OTSchedule), [
+            {'ot_date': first_day + timedelta(days=i)} for i in range(args.schedules)
+        ])
+        statuses = ['pending', 'confirmed', 'confirmed', 'declined_admin', 'delegated', 'sub_confirmed', 'sub_declined']
+        responses = []
+        for schedule_id, in db.session.query(ot_app.OTSchedule.id):
+            # ตัวแทนในตารางเดียวกันต้องไม่ซ้ำกันและไม่ใช่ผู้มีสิทธิ์หลัก (uq_ot_response_active_delegation)
+            picked = rng.sample(user_ids, 2 * args.per_schedule)
+            primary_user_ids, delegate_ids = picked[:args.per_schedule], picked[args.per_schedule:]
+            for primary_user_id, delegate_id in zip(primary_user_ids, delegate_ids):
+                status = rng.choice(statuses)
+                responses.append({
+                    'token': f'{schedule_id}-{primary_user_id}',
+                    'schedule_id': schedule_id,
+                    'primary_user_id': primary_user_id,
+                    'response_status': status,
+                    'delegated_to_user_id': delegate_id if status.startswith(('delegated', 'sub_')) else None,
+                })
+        db.session.execute(db.insert(ot_app.OTResponse), responses)
+        db.session.commit()
+        ot_app.rebuild_ot_tally()
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(db.text('ANALYZE'))
+        else:
+            db.session.execute(db.text('ANALYZE ot_response'))
+        db.session.commit()
+        print(f"seed: {args.users} users, {args.schedules} schedules, {len(responses)} responses "
+              f"({time.perf_counter() - started:.1f}s)")
+
+        ot_app.run_migrations()
+        sample_schedule_id = responses[len(responses) // 2]['schedule_id']
+        failed = ot_app.run_plan_checks(
+            ot_app.hot_query_checks(sample_schedule_id, tuple(user_ids[:2])) + ot_app.report_query_checks()
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
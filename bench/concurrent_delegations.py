@@ -0,0 +1,144 @@
+"""ยิง request พร้อมกันใส่ตาราง OT เดียว แล้วตรวจว่าผลลัพธ์ถูกต้อง (ไม่มีตัวแทนซ้ำ, ไม่มีการเขียนทับ, ชนกันได้ 409)
+
+    1. พนักงาน N คนมอบสิทธิ์ให้ "เพื่อนคนเดียวกัน" พร้อมกัน -> สำเร็จ 1 คน ที่เหลือ 409
+    2. แบบสำรวจเดียวกันถูกส่งพร้อมกันหลายครั้ง (ยืนยัน/สละสิทธิ์) -> สำเร็จ 1 ครั้ง ที่เหลือ 409
+    3. Admin หลายหน้าต่างมอบหมายตัวแทนคนเดียวกันให้หลายแถวพร้อมกัน -> สำเร็จ 1 แถว ที่เหลือ 409
+
+ค่าเริ่มต้นใช้ SQLite ชั่วคราว (เขียนได้ทีละ transaction อยู่แล้ว); ควรรันบน PostgreSQL ว่างสำหรับทดสอบด้วย (ห้ามใช้ฐานจริง)
+
+    python bench/concurrent_delegations.py --parallel 20
+    python bench/concurrent_delegations.py --database-url postgresql://localhost/ot_concurrency_check
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter
+from datetime import date, timedelta
+
+
+def fire(app, requests_to_send):
+    """ส่ง (client_factory, method, url, kwargs) ทั้งหมดพร้อมกัน -> รายการ status code"""
+    barrier = threading.Barrier(len(requests_to_send))
+    results = [None] * len(requests_to_send)
+
+    def worker(index, make_client, method, url, kwargs):
+        client = make_client()
+        barrier.wait()
+        results[index] = getattr(client, method)(url, **kwargs).status_code
+
+    threads = [threading.Thread(target=worker, args=(i,) + item) for i, item in enumerate(requests_to_send)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def check(name, codes, expect_ok=1):
+    counts = Counter(codes)
+    ok = counts.get(200, 0) == expect_ok and counts.get(200, 0) + counts.get(409, 0) == len(codes)
+    print(f"{'OK  ' if ok else 'FAIL'} {name}: {dict(counts)}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parallel', type=int, default=10)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(tmpdir, 'concurrency.db')}"
+    os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'bench-token')
+    os.environ.setdefault('LINE_CHANNEL_SECRET', 'bench-secret')
+    os.environ.setdefault('FLASK_SECRET_KEY', 'bench-secret-key')
+    os.environ['NOTIFICATION_TRANSPORT'] = 'memory' # ไม่ส่ง LINE จริง
+    os.environ.setdefault('LINE_TARGET_GROUP_ID', 'Cbench')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as ot_app
+    db, app = ot_app.db, ot_app.create_app()
+    n = args.parallel
+
+    with app.app_context():
+        ot_app.initialize_database()
+        if ot_app.User.query.first():
+            sys.exit("ฐานข้อมูลนี้มีข้อมูลอยู่แล้ว: ใช้ฐานข้อมูลว่างสำหรับทดสอบเท่านั้น")
+        admin = ot_app.User(username='admin', full_name='Admin', is_admin=True)
+        admin.set_password('bench')
+        db.session.add(admin)
+        users = [ot_app.User(username=f'user{i}', full_name=f'User {i}') for i in range(2 * n + 2)]
+        db.session.add_all(users)
+        schedule = ot_app.OTSchedule(ot_date=date.today() + timedelta(days=7))
+        db.session.add(schedule)
+        db.session.flush()
+        primaries, target, admin_pick = users[:2 * n], users[2 * n], users[2 * n + 1]
+        responses = [ot_app.OTResponse(schedule_id=schedule.id, primary_user_id=u.id) for u in primaries]
+        db.session.add_all(responses)
+        db.session.commit()
+        response_ids = [r.id for r in responses]
+        tokens = {r.id: r.survey_token for r in responses}
+        target_id, admin_pick_id, schedule_id = target.id, admin_pick.id, schedule.id
+
+    def employee():
+        return app.test_client()
+
+    def admin_client():
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'bench'})
+        return client
+
+    passed = True
+
+    # 1. มอบสิทธิ์ให้คนเดียวกันพร้อมกัน
+    codes = fire(app, [
+        (employee, 'post', '/submit-ot-response',
+         {'json': {'token': tokens[rid], 'status': 'declined', 'delegated_to_id': target_id}})
+        for rid in response_ids[:n - 1]
+    ])
+    passed &= check('delegate to same colleague', codes)
+
+    # 2. แบบสำรวจเดียวกันถูกส่งซ้ำพร้อมกัน
+    rid = response_ids[n - 1]
+    codes = fire(app, [
+        (employee, 'post', '/submit-ot-response',
+         {'json': {'token': tokens[rid], 'status': 'confirmed'} if i % 2 else
+                  {'token': tokens[rid], 'status': 'declined', 'let_admin_decide': True}})
+        for i in range(n)
+    ])
+    passed &= check('same survey submitted twice', codes)
+
+    # 3. Admin มอบหมายตัวแทนคนเดียวกันให้หลายแถวพร้อมกัน
+    with app.app_context():
+        pending = ot_app.OTResponse.query.filter(ot_app.OTResponse.id.in_(response_ids[n:])).all()
+        for response in pending:
+            response.response_status = 'declined_admin'
+            response.let_admin_decide = True
+        db.session.commit()
+    codes = fire(app, [
+        (admin_client, 'post', f'/admin/assign-substitute/{rid}',
+         {'data': {'user_id': admin_pick_id}, 'headers': {'Accept': 'application/json'}})
+        for rid in response_ids[n:]
+    ])
+    passed &= check('admin assigns same substitute', codes)
+
+    with app.app_context():
+        active = ot_app.OTResponse.query.filter(
+            ot_app.OTResponse.schedule_id == schedule_id,
+            ot_app.OTResponse.response_status.in_(ot_app.ACTIVE_DELEGATION_STATUSES)
+        ).all()
+        per_substitute = Counter(r.delegated_to_user_id for r in active)
+        unique = all(count == 1 for count in per_substitute.values())
+        print(f"{'OK  ' if unique else 'FAIL'} active delegations per substitute: {dict(per_substitute)}")
+        passed &= unique
+
+        changes = ot_app.OTResponseChange.query.filter_by(response_id=response_ids[n - 1]).count()
+        print(f"{'OK  ' if changes == 1 else 'FAIL'} change log rows for the double-submitted survey: {changes}")
+        passed &= changes == 1
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""LINE Messaging API ปลอมบนเครื่อง: ตอบ push/reply ด้วย latency และอัตรา error ที่กำหนดได้ (ไม่แตะ LINE จริง)
+
+ใช้กับแอปผ่าน NOTIFICATION_TRANSPORT=stub (LINE_STUB_URL ค่าเริ่มต้นคือ http://127.0.0.1:8808)
+
+    python bench/fake_line_server.py --latency-ms 100 --jitter-ms 50 --error-rate 0.05 --rate-limit-rate 0.02
+    NOTIFICATION_TRANSPORT=stub flask --app app run
+
+    curl http://127.0.0.1:8808/stats   # จำนวน request แยกตาม endpoint / status
+
+หรือ import แล้วเริ่มใน process เดียวกัน: server, url = start_fake_line_server(latency_ms=50)
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MESSAGE_PATHS = ('/v2/bot/message/push', '/v2/bot/message/reply', '/v2/bot/message/multicast')
+RETRY_KEY_MEMORY = 100000
+
+
+class FakeLineServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # fan-out เปิด connection พร้อมกันหลายร้อยอัน
+
+    def __init__(self, address, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 client_error_rate=0.0, retry_after=1, seed=None):
+        super().__init__(address, _FakeLineHandler)
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.client_error_rate = client_error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.accepted_retry_keys = OrderedDict() # X-Line-Retry-Key -> request id ที่รับไปแล้ว
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def handle_error(self, request, client_address):
+        pass # client ปิด connection กลางคัน (เช่น process จบ)
+
+    def pick_status(self):
+        """สุ่มผลลัพธ์ของ request นี้ตามอัตราที่ตั้งไว้"""
+        roll = self.rng.random()
+        for status, rate in ((500, self.error_rate), (429, self.rate_limit_rate), (400, self.client_error_rate)):
+            if roll < rate:
+                return status
+            roll -= rate
+        return 200
+
+    def accept_retry_key(self, retry_key):
+        """-> request id ถ้า retry key นี้เคยสำเร็จแล้ว (LINE ตอบ 409) ไม่งั้นจำไว้แล้วคืน None"""
+        with self.lock:
+            if retry_key in self.accepted_retry_keys:
+                return self.accepted_retry_keys[retry_key]
+            self.accepted_retry_keys[retry_key] = uuid.uuid4().hex
+            while len(self.accepted_retry_keys) > RETRY_KEY_MEMORY:
+                self.accepted_retry_keys.popitem(last=False)
+            return None
+
+    def stats(self):
+        with self.lock:
+            return {f'{path} {status}': count for (path, status), count in sorted(self.counts.items())}
+
+
+class _FakeLineHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+    disable_nagle_algorithm = True
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            return self._send_json(200, self.server.stats())
+        self._send_json(404, {"message": "Not found"})
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path not in MESSAGE_PATHS:
+            return self._send_json(404, {"message": "Not found"})
+
+        time.sleep(server.latency + server.rng.uniform(0, server.jitter))
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            status, data, headers = 401, {"message": "Authentication failed due to the following reason: no token"}, {}
+        else:
+            status, headers = server.pick_status(), {}
+            if status == 500:
+                data = {"message": "An error occurred on the server"}
+            elif status == 429:
+                data = {"message": "Too Many Requests"}
+                headers['Retry-After'] = str(server.retry_after)
+            elif status == 400:
+                data = {"message": "The request body has 1 error(s)"}
+            else:
+                retry_key = self.headers.get('X-Line-Retry-Key')
+                accepted_id = server.accept_retry_key(retry_key) if retry_key else None
+                if accepted_id:
+                    status, data = 409, {"message": "The retry key is already accepted"}
+                    headers['X-Line-Accepted-Request-Id'] = accepted_id
+                else:
+                    data = {"sentMessages": [{"id": uuid.uuid4().hex[:18], "quoteToken": "q"}]}
+
+        with server.lock:
+            server.counts[(self.path, status)] += 1
+        self._send_json(status, data, headers)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_line_server(port=0, **options):
+    """เริ่ม server ใน background thread -> (server, url); หยุดด้วย server.shutdown()"""
+    server = FakeLineServer(('127.0.0.1', port), **options)
+    threading.Thread(target=server.serve_forever, name='fake-line-server', daemon=True).start()
+    return server, server.url
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='สุ่ม latency เพิ่ม 0..jitter')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='สัดส่วนที่ตอบ 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='สัดส่วนที่ตอบ 429 + Retry-After')
+    parser.add_argument('--client-error-rate', type=float, default=0.0, help='สัดส่วนที่ตอบ 400 (retry ไม่ได้)')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--seed', type=int)
+
+
+def server_options(args):
+    return {
+        'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms, 'error_rate': args.error_rate,
+        'rate_limit_rate': args.rate_limit_rate, 'client_error_rate': args.client_error_rate,
+        'retry_after': args.retry_after, 'seed': args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8808)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeLineServer(('127.0.0.1', args.port), **server_options(args))
+    print(f"fake LINE API at {server.url} (NOTIFICATION_TRANSPORT=stub LINE_STUB_URL={server.url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""เปรียบเทียบ throughput ของงานที่รอ LINE: โหมด sync (thread pool) vs LINE_ASYNC_MODE=1 (event loop + semaphore)
+
+ยิงไปที่ bench/fake_line_server.py (NOTIFICATION_TRANSPORT=stub) หรือเก็บในหน่วยความจำ (--transport memory)
+ไม่แตะ LINE จริง; แต่ละโหมดรันใน process แยก เพราะโหมดถูกอ่านตอน import
+    1. create-schedule: เวลาตั้งแต่สร้างตารางจนข้อความใน Outbox ถูกส่งครบ N คน (fan-out ใน background)
+    2. remind-pending: เตือน N คนใน request เดียว (fan-out ที่ request ต้องรอ)
+    3. submit-ot-response: T thread ส่งแบบสำรวจพร้อมกัน แต่ละครั้งแจ้งเข้ากลุ่ม LINE (~ gthread worker 1 ตัว)
+
+    python bench/line_fanout_throughput.py --recipients 200 --latency-ms 100 --threads 8
+    python bench/line_fanout_throughput.py --latency-ms 100 --jitter-ms 200 --error-rate 0.05 --rate-limit-rate 0.02
+    python bench/line_fanout_throughput.py --transport memory   # overhead ของแอปเอง (DB / thread) ไม่รวม network
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+from fake_line_server import add_arguments, server_options, start_fake_line_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child(args):
+    """1 โหมด: พิมพ์ผลแต่ละ scenario เป็น JSON"""
+    sys.path.insert(0, ROOT)
+    import app as ot_app
+    db, app = ot_app.db, ot_app.create_app()
+    n = args.recipients
+
+    with app.app_context():
+        ot_app.initialize_database()
+        admin = ot_app.User(username='admin', full_name='Admin', is_admin=True)
+        admin.set_password('bench')
+        db.session.add(admin)
+        users = [ot_app.User(username=f'user{i}', full_name=f'User {i}', line_user_id=f'U{i:032d}') for i in range(n)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [u.id for u in users]
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'bench'})
+    # เปิด connection / โหลด SDK ก่อนจับเวลา
+    ot_app.line_fanout('push_text', [('Uwarmup', 'warmup')] * min(n, args.threads * 4))
+    results = {}
+
+    # 1. สร้างตาราง -> รอจน Outbox ส่งครบ
+    started = time.perf_counter()
+    response = client.post('/api/create-schedule', json={
+        'date': (date.today() + timedelta(days=7)).isoformat(), 'user_ids': user_ids
+    })
+    assert response.status_code == 201, response.get_json()
+    schedule_id = response.get_json()['schedule_id']
+    status_url = response.get_json()['status_url']
+    while True:
+        counts = client.get(status_url).get_json()['counts']
+        if not counts.get('queued') and not counts.get('sending'):
+            break
+        time.sleep(0.01)
+    results['create_schedule_s'] = time.perf_counter() - started
+    results['create_schedule_sent'] = counts.get('sent', 0)
+
+    # 2. เตือนทุกคนที่ค้างตอบใน request เดียว
+    started = time.perf_counter()
+    response = client.post(f'/api/schedules/{schedule_id}/remind-pending')
+    results['remind_pending_s'] = time.perf_counter() - started
+    results['remind_pending_sent'] = response.get_json()['sent']
+
+    # 3. T thread ส่งแบบสำรวจ (สละสิทธิ์ให้ Admin เลือก -> แจ้งกลุ่ม) พร้อมกันจนครบ N ครั้ง
+    with app.app_context():
+        tokens = [r.survey_token for r in ot_app.OTResponse.query.filter_by(schedule_id=schedule_id)]
+    pending = list(tokens)
+    lock = threading.Lock()
+    codes = []
+
+    def worker():
+        survey_client = app.test_client()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                token = pending.pop()
+            code = survey_client.post('/submit-ot-response', json={
+                'token': token, 'status': 'declined', 'let_admin_decide': True
+            }).status_code
+            with lock:
+                codes.append(code)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results['submit_s'] = time.perf_counter() - started
+    results['submit_ok'] = codes.count(200)
+    print('RESULT ' + json.dumps(results))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recipients', type=int, default=200)
+    parser.add_argument('--transport', choices=('stub', 'memory'), default='stub')
+    add_arguments(parser)
+    parser.set_defaults(latency_ms=100.0)
+    parser.add_argument('--threads', type=int, default=8, help='thread ต่อ worker (เหมือน gunicorn --threads)')
+    parser.add_argument('--concurrency', type=int, default=64, help='LINE_ASYNC_CONCURRENCY ของโหมด async')
+    parser.add_argument('--child', action='store_true')
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    server, stub_url = start_fake_line_server(**server_options(args))
+
+    rows = {}
+    for mode in ('sync', 'async'):
+        env = dict(os.environ)
+        env.update({
+            'DATABASE_URL': f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'fanout.db')}",
+            'NOTIFICATION_TRANSPORT': args.transport,
+            'LINE_STUB_URL': stub_url,
+            'LINE_CHANNEL_ACCESS_TOKEN': 'bench-token',
+            'LINE_CHANNEL_SECRET': 'bench-secret',
+            'LINE_TARGET_GROUP_ID': 'Cbench',
+            'FLASK_SECRET_KEY': 'bench-secret-key',
+            'LINE_OUTBOX_WORKERS': str(args.threads),
+            'LINE_ASYNC_MODE': '1' if mode == 'async' else '0',
+            'LINE_ASYNC_CONCURRENCY': str(args.concurrency),
+        })
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'] + sys.argv[1:],
+                              cwd=ROOT, env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            sys.exit(f"โหมด {mode} ล้มเหลว:\n{proc.stderr[-2000:]}")
+        result_line = [line for line in proc.stdout.splitlines() if line.startswith('RESULT ')][-1]
+        rows[mode] = json.loads(result_line[len('RESULT '):])
+
+    n = args.recipients
+    network = (f"stub latency {args.latency_ms}+{args.jitter_ms}ms, errors 500={args.error_rate} 429={args.rate_limit_rate}"
+               if args.transport == 'stub' else 'in-memory transport')
+    print(f"{n} recipients, {network}, {args.threads} threads, async concurrency {args.concurrency}")
+    print(f"{'':<22}{'sync':>16}{'async':>16}")
+    for key, label in (('create_schedule', 'create-schedule'), ('remind_pending', 'remind-pending'), ('submit', 'submit-ot-response')):
+        cells = []
+        for mode in ('sync', 'async'):
+            seconds = rows[mode][f'{key}_s']
+            cells.append(f"{n / seconds:8.1f} msg/s" if key != 'submit' else f"{n / seconds:8.1f} req/s")
+        print(f"{label:<22}{cells[0]:>16}{cells[1]:>16}")
+    for mode, row in rows.items():
+        if (row['create_schedule_sent'], row['remind_pending_sent'], row['submit_ok']) != (n, n, n):
+            print(f"WARN {mode}: ส่งไม่ครบ {row}")
+    if args.transport == 'stub':
+        print(f"fake LINE server: {server.stats()}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""วัดเวลา cold start ต่อ worker: เริ่ม process ใหม่ N ตัวพร้อมกัน (เหมือน gunicorn fork worker โดยไม่ --preload)
+แต่ละตัว import app -> create_app() -> request แรก -> request แรกที่แตะ DB แล้วรายงานเวลาของแต่ละช่วง
+
+    python bench/startup_time.py --workers 4
+    python bench/startup_time.py --workers 4 --run-migrations-on-startup   # เทียบกับการตรวจ schema ทุก worker
+    python bench/startup_time.py --database-url postgresql://localhost/ot_startup_check
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child():
+    """1 worker: พิมพ์เวลาแต่ละช่วง (ms) เป็น JSON"""
+    timings = {}
+    started = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    import app as ot_app
+    timings['import'] = (time.perf_counter() - started) * 1000
+
+    mark = time.perf_counter()
+    app = ot_app.create_app()
+    timings['create_app'] = (time.perf_counter() - mark) * 1000
+
+    client = app.test_client()
+    mark = time.perf_counter()
+    assert client.get('/login').status_code == 200
+    timings['first_request'] = (time.perf_counter() - mark) * 1000
+
+    # ลิงก์ survey แบบเก่า (uuid) ที่ไม่มีอยู่จริง: query ฐานข้อมูล 1 ครั้งแล้วได้ 404
+    mark = time.perf_counter()
+    assert client.get('/survey/00000000-0000-0000-0000-000000000000').status_code == 404
+    timings['first_db_request'] = (time.perf_counter() - mark) * 1000
+
+    timings['linebot_loaded'] = any(name.startswith('linebot') for name in sys.modules)
+    print(json.dumps(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--database-url')
+    parser.add_argument('--run-migrations-on-startup', action='store_true')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'startup.db')}"
+    env.setdefault('FLASK_SECRET_KEY', 'bench-secret-key')
+    env.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'bench-token')
+    env.setdefault('LINE_CHANNEL_SECRET', 'bench-secret')
+    env['RUN_MIGRATIONS_ON_STARTUP'] = '1' if args.run_migrations_on_startup else '0'
+
+    # เตรียม schema ครั้งเดียวแบบตอน deploy (ไม่นับเวลา)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'db-upgrade'],
+                   cwd=ROOT, env=env, check=True, capture_output=True)
+
+    rows = []
+    for _ in range(args.rounds):
+        spawned_at = time.perf_counter()
+        procs = [
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child'],
+                             cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            for _ in range(args.workers)
+        ]
+        for proc in procs:
+            out, _ = proc.communicate()
+            if proc.returncode != 0:
+                sys.exit(f"worker ล้มเหลว (exit {proc.returncode})")
+            timings = json.loads(out.strip().splitlines()[-1])
+            # เวลาตั้งแต่ spawn ถึงตอบ request แรกเสร็จ (รวมเวลาเริ่ม interpreter)
+            timings['process_exit'] = (time.perf_counter() - spawned_at) * 1000
+            rows.append(timings)
+
+    mode = 'schema check on startup' if args.run_migrations_on_startup else 'lazy (db-upgrade at deploy)'
+    print(f"{args.workers} workers x {args.rounds} rounds, {mode}, linebot loaded: {any(r['linebot_loaded'] for r in rows)}")
+    for key in ('import', 'create_app', 'first_request', 'first_db_request'):
+        samples = [r[key] for r in rows]
+        print(f"{key:<18} mean={statistics.mean(samples):8.1f}ms  max={max(samples):8.1f}ms")
+    ttfr = [r['import'] + r['create_app'] + r['first_request'] for r in rows]
+    print(f"{'time to 1st req':<18} mean={statistics.mean(ttfr):8.1f}ms  max={max(ttfr):8.1f}ms")
+
+
+if __name__ == '__main__':
+    if '--child' in sys.argv:
+        child()
+    else:
+        main()
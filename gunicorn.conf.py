@@ -0,0 +1,35 @@
+"""ค่า gunicorn สำหรับ production (gunicorn อ่านไฟล์นี้เองเมื่อรันจากโฟลเดอร์โปรเจกต์)
+
+    gunicorn -c gunicorn.conf.py "app:create_app()"
+
+ใช้ worker แบบ gthread ทั้งสองโหมด (หน้า Dashboard เปิด stream อัปเดตสดค้างไว้ 1 thread ต่อหน้าจอ)
+    * โหมด sync (ค่าเริ่มต้น): thread ของ request รอ LINE เอง -> ต้องมี thread มากพอให้ request อื่นไม่ต้องรอ
+    * LINE_ASYNC_MODE=1: LINE ทั้งหมดวิ่งบน event loop ของแต่ละ worker (ข้อความเข้ากลุ่มไม่ถูกรอใน request)
+      จึงใช้ thread น้อยกว่าได้ ส่วนจำนวนที่ยิง LINE พร้อมกันคุมด้วย LINE_ASYNC_CONCURRENCY
+ห้ามใช้ worker แบบ gevent/eventlet: monkey patch จะชนกับ event loop ใน thread ของโหมด async
+"""
+import os
+
+LINE_ASYNC_MODE = os.environ.get('LINE_ASYNC_MODE', '0') == '1'
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# rate limit ของ LINE อยู่แยกในแต่ละ worker: แอปแบ่ง LINE_RATE_LIMIT_PER_SEC ของทั้ง channel ตามจำนวนนี้
+os.environ['LINE_RATE_LIMIT_WORKERS'] = str(workers)
+threads = int(os.environ.get('GUNICORN_THREADS', 8 if LINE_ASYNC_MODE else 16))
+
+# fan-out ใน request (เช่น เตือนทุกคนที่ค้างตอบ) อาจรอ retry/backoff ของ LINE ได้หลายวินาที
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+# ให้ worker ที่กำลังถูกหยุดส่ง Outbox ที่ค้างอยู่ให้จบก่อน (ที่ยังไม่จบจะถูกส่งต่อตอน worker ใหม่เริ่ม)
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# ห้าม preload: thread ของ Outbox / webhook / event loop ต้องเริ่มใน worker หลัง fork เท่านั้น
+preload_app = False
+
+
+def post_worker_init(worker):
+    # กู้ Outbox ที่ค้างเฉพาะใน worker ที่เสิร์ฟเว็บ (ไม่ใช่ตอน release `db-upgrade` หรือคำสั่ง CLI อื่น)
+    from app import start_line_outbox_recovery
+    start_line_outbox_recovery(worker.wsgi)